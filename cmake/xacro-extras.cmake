@@ -28,16 +28,58 @@ function(xacro_add_xacro_file input)
   set(multiValueArgs REMAP DEPENDS)
   cmake_parse_arguments(_XACRO "${options}" "${oneValueArgs}" "${multiValueArgs}" ${ARGN})
 
+  _xacro_prepare_file(${input} ${_XACRO_UNPARSED_ARGUMENTS})
+
+  ## export abs_output to parent scope in variable ${_XACRO_OUTPUT}
+  if(NOT _XACRO_OUTPUT)
+    set(_XACRO_OUTPUT XACRO_OUTPUT_FILE)
+  endif()
+  set(${_XACRO_OUTPUT} ${_xacro_abs_output} PARENT_SCOPE)
+
+  ## command to actually call xacro
+  list(JOIN AMENT_PREFIX_PATH ":" AMENT_PREFIX_PATH_ENV) # format as colon-separated list
+  if(_XACRO_USE_DEPFILE)
+    # dependencies are reported by xacro itself at build time
+    set(_depfile_args --depfile ${_xacro_abs_output}.d)
+    set(_depfile DEPFILE ${_xacro_abs_output}.d)
+  endif()
+  add_custom_command(OUTPUT ${_xacro_abs_output}
+    COMMAND ${CMAKE_COMMAND} -E env AMENT_PREFIX_PATH="${PROJECT_BUILD_INDEX}:${AMENT_PREFIX_PATH_ENV}" xacro -o ${_xacro_abs_output} ${_depfile_args} ${input} ${_XACRO_REMAP}
+    DEPENDS ${input} ${_xacro_deps} ${_XACRO_DEPENDS}
+    ${_depfile}
+    WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
+    COMMENT "xacro: generating ${_xacro_output} from ${input}"
+    )
+endfunction(xacro_add_xacro_file)
+
+
+# DEPFILE is supported by Ninja generators and, since CMake 3.20, by Makefile generators as well
+if(CMAKE_GENERATOR MATCHES "Ninja" OR
+   (CMAKE_VERSION VERSION_GREATER_EQUAL 3.20 AND CMAKE_GENERATOR MATCHES "Makefiles"))
+  set(_XACRO_USE_DEPFILE TRUE)
+else()
+  set(_XACRO_USE_DEPFILE FALSE)
+endif()
+
+
+## _xacro_prepare_file(<input> [<output>])
+##
+## internal helper: determines the output file of <input> and its dependencies,
+## returned in variables _xacro_output, _xacro_abs_output, and _xacro_deps
+## (uses _XACRO_REMAP from the caller's scope)
+## Dependencies are only determined at configure time if the generator doesn't support depfiles.
+function(_xacro_prepare_file input)
   ## process arguments
   # retrieve output file name
-  if(_XACRO_UNPARSED_ARGUMENTS)
+  set(_args ${ARGN})
+  if(_args)
     # output file explicitly specified
-    list(GET _XACRO_UNPARSED_ARGUMENTS 0 output)
-    list(REMOVE_AT _XACRO_UNPARSED_ARGUMENTS 0)
+    list(GET _args 0 output)
+    list(REMOVE_AT _args 0)
     # any remaining unparsed args?
-    if(_XACRO_UNPARSED_ARGUMENTS)
-      message(WARNING "unknown arguments: ${_XACRO_UNPARSED_ARGUMENTS}")
-    endif(_XACRO_UNPARSED_ARGUMENTS)
+    if(_args)
+      message(WARNING "unknown arguments: ${_args}")
+    endif(_args)
   else()
     # implicitly determine output file from input
     if(${input} MATCHES "(.*)[.]xacro$")
@@ -54,26 +96,23 @@ function(xacro_add_xacro_file input)
     set(abs_output ${CMAKE_CURRENT_BINARY_DIR}/${output})
   endif()
 
-  ## export abs_output to parent scope in variable ${_XACRO_OUTPUT}
-  if(NOT _XACRO_OUTPUT)
-    set(_XACRO_OUTPUT XACRO_OUTPUT_FILE)
-  endif()
-  set(${_XACRO_OUTPUT} ${abs_output} PARENT_SCOPE)
-
   ## Call out to xacro to determine dependencies
-  message(STATUS "xacro: determining deps for: " ${input} " ...")
-  execute_process(COMMAND xacro --deps ${input} ${_XACRO_REMAP}
-    WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
-    RESULT_VARIABLE _xacro_result
-    ERROR_VARIABLE _xacro_err
-    OUTPUT_VARIABLE _xacro_deps_result
-    OUTPUT_STRIP_TRAILING_WHITESPACE)
-  if(_xacro_result)
-    message(WARNING "failed to determine deps for: ${input}
+  set(_xacro_deps_result)
+  if(NOT _XACRO_USE_DEPFILE)
+    message(STATUS "xacro: determining deps for: " ${input} " ...")
+    execute_process(COMMAND xacro --deps ${input} ${_XACRO_REMAP}
+      WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
+      RESULT_VARIABLE _xacro_result
+      ERROR_VARIABLE _xacro_err
+      OUTPUT_VARIABLE _xacro_deps_result
+      OUTPUT_STRIP_TRAILING_WHITESPACE)
+    if(_xacro_result)
+      message(WARNING "failed to determine deps for: ${input}
 ${_xacro_err}")
-  endif(_xacro_result)
+    endif(_xacro_result)
 
-  separate_arguments(_xacro_deps_result)
+    separate_arguments(_xacro_deps_result)
+  endif()
 
   ## HACK: ament package resolution doesn't work at build time yet
   # - Augment AMENT_PREFIX_PATH to include ${PROJECT_BINARY_DIR}/ament_cmake_index
@@ -82,15 +121,11 @@ ${_xacro_err}")
   execute_process(COMMAND ${CMAKE_COMMAND} -E make_directory "${PROJECT_BUILD_INDEX}/share")
   execute_process(COMMAND ${CMAKE_COMMAND} -E create_symlink "${PROJECT_SOURCE_DIR}" "${PROJECT_BUILD_INDEX}/share/${PROJECT_NAME}")
 
-  ## command to actually call xacro
-  list(JOIN AMENT_PREFIX_PATH ":" AMENT_PREFIX_PATH_ENV) # format as colon-separated list
-  add_custom_command(OUTPUT ${abs_output}
-    COMMAND ${CMAKE_COMMAND} -E env AMENT_PREFIX_PATH="${PROJECT_BUILD_INDEX}:${AMENT_PREFIX_PATH_ENV}" xacro -o ${abs_output} ${input} ${_XACRO_REMAP}
-    DEPENDS ${input} ${_xacro_deps_result} ${_XACRO_DEPENDS}
-    WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
-    COMMENT "xacro: generating ${output} from ${input}"
-    )
-endfunction(xacro_add_xacro_file)
+  set(PROJECT_BUILD_INDEX ${PROJECT_BUILD_INDEX} PARENT_SCOPE)
+  set(_xacro_output ${output} PARENT_SCOPE)
+  set(_xacro_abs_output ${abs_output} PARENT_SCOPE)
+  set(_xacro_deps ${_xacro_deps_result} PARENT_SCOPE)
+endfunction(_xacro_prepare_file)
 
 
 ## xacro_install(<target> <output> [<output> ...] DESTINATION <path>)
@@ -108,38 +143,77 @@ endfunction(xacro_install)
 
 
 ## xacro_add_files(<file> [<file> ...] [REMAP <arg> <arg> ...] [DEPENDS <arg> <arg>]
-##                 [TARGET <target>] [INSTALL [DESTINATION <path>]])
+##                 [TARGET <target>] [INSTALL [DESTINATION <path>]] [BATCH])
 ##
 ## create make <target> to generate xacro files and optionally install to share/<package>/<path>
+## By default, each file is generated by its own xacro call, such that only outputs
+## whose dependencies changed are regenerated.
+## With BATCH, all files are generated by a single xacro call (xacro --manifest <file>),
+## sharing interpreter startup and xacro's caches. However, any change to a dependency of
+## any of the files then regenerates all of them.
 function(xacro_add_files)
   # parse arguments
-  set(options INSTALL)
+  set(options INSTALL BATCH)
   set(oneValueArgs OUTPUT TARGET DESTINATION)
   set(multiValueArgs REMAP DEPENDS)
   cmake_parse_arguments(_XACRO "${options}" "${oneValueArgs}" "${multiValueArgs}" ${ARGN})
 
   ## process arguments
-  # prepare REMAP args (prepending REMAP)
-  if(_XACRO_REMAP)
-    set(_XACRO_REMAP REMAP ${_XACRO_REMAP})
-  endif()
-  # prepare DEPENDS args (prepending DEPENDS)
-  if(_XACRO_DEPENDS)
-    set(_XACRO_DEPENDS DEPENDS ${_XACRO_DEPENDS})
-  endif()
-
   # have INSTALL option, but no TARGET: fallback to default target
   if(_XACRO_INSTALL AND NOT _XACRO_TARGET)
     set(_XACRO_TARGET _xacro_auto_generate)
   endif()
 
-  foreach(input ${_XACRO_UNPARSED_ARGUMENTS})
-    # call to main function
-    xacro_add_xacro_file(${input} ${_XACRO_OUTPUT} ${_XACRO_REMAP} ${_XACRO_DEPENDS})
-    list(APPEND outputs ${XACRO_OUTPUT_FILE})
-  endforeach()
+  set(outputs)
+  if(_XACRO_BATCH)
+    # collect outputs and dependencies of all inputs into a manifest (tab-separated)
+    set(deps)
+    set(manifest_content)
+    foreach(input ${_XACRO_UNPARSED_ARGUMENTS})
+      _xacro_prepare_file(${input} ${_XACRO_OUTPUT})
+      list(APPEND outputs ${_xacro_abs_output})
+      list(APPEND deps ${input} ${_xacro_deps})
+      string(APPEND manifest_content "${input}\t${_xacro_abs_output}\n")
+    endforeach()
+  else()
+    # prepare REMAP and DEPENDS args (prepending REMAP and DEPENDS)
+    if(_XACRO_REMAP)
+      set(remap_args REMAP ${_XACRO_REMAP})
+    endif()
+    if(_XACRO_DEPENDS)
+      set(depends_args DEPENDS ${_XACRO_DEPENDS})
+    endif()
+    foreach(input ${_XACRO_UNPARSED_ARGUMENTS})
+      # call to main function
+      xacro_add_xacro_file(${input} ${_XACRO_OUTPUT} ${remap_args} ${depends_args})
+      list(APPEND outputs ${XACRO_OUTPUT_FILE})
+    endforeach()
+  endif()
 
   if(outputs)
+    if(_XACRO_BATCH)
+      # the manifest is named by the hash of its content: only write it once, keeping its
+      # timestamp on reconfiguration, such that outputs depending on it aren't regenerated
+      string(MD5 manifest_hash "${manifest_content}")
+      set(manifest "${CMAKE_CURRENT_BINARY_DIR}/xacro_${manifest_hash}.manifest")
+      if(NOT EXISTS "${manifest}")
+        file(WRITE "${manifest}" "${manifest_content}")
+      endif()
+      list(REMOVE_DUPLICATES deps)
+      list(JOIN AMENT_PREFIX_PATH ":" AMENT_PREFIX_PATH_ENV) # format as colon-separated list
+      if(_XACRO_USE_DEPFILE)
+        set(_depfile_args --depfile "${manifest}.d")
+        set(_depfile DEPFILE "${manifest}.d")
+      endif()
+      add_custom_command(OUTPUT ${outputs}
+        COMMAND ${CMAKE_COMMAND} -E env AMENT_PREFIX_PATH="${PROJECT_BUILD_INDEX}:${AMENT_PREFIX_PATH_ENV}" xacro --manifest "${manifest}" ${_depfile_args} ${_XACRO_REMAP}
+        DEPENDS "${manifest}" ${deps} ${_XACRO_DEPENDS}
+        ${_depfile}
+        WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
+        COMMENT "xacro: generating ${_XACRO_UNPARSED_ARGUMENTS}"
+        )
+    endif()
+
     # link to target
     add_custom_target(${PROJECT_NAME}_${_XACRO_TARGET} ALL DEPENDS ${outputs})
 
@@ -14,7 +14,7 @@ function _complete_xacro {
     _init_completion || return # this handles default completion (variables, redirection)
 
     if [[ ${cur} =~ \-.* ]]; then
-        COMPREPLY+=($(compgen -W "--help --deps -q -v --verbosity=" -- ${cur}))
+        COMPREPLY+=($(compgen -W "--help --deps --depfile= --jobs= --manifest= --cache-dir= --watch --serve --socket= -q -v --verbosity=" -- ${cur}))
         [[ $COMPREPLY == *= ]] && compopt -o nospace
     else
         local FILE=$(_file_arg)
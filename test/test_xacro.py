@@ -35,6 +35,7 @@
 import ast
 from contextlib import contextmanager
 import itertools
+import json
 import math
 import os.path
 import re
@@ -353,6 +354,72 @@ class TestXacroFunctions(unittest.TestCase):
         for sep in [' ', ',', ';', ', ']:
             self.assertEqual(xacro.tokenize(sep.join(tokens)), tokens)
 
+    def test_compile_expr_cache(self):
+        xacro.compile_expr.cache_clear()
+        code = xacro.compile_expr('1 + 2')
+        self.assertTrue(xacro.compile_expr('1 + 2') is code)
+        info = xacro.compile_expr.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        self.assertEqual(xacro.safe_eval('  1 + 2 ', {}), 3)  # stripped expression is cached too
+        self.assertEqual(xacro.compile_expr.cache_info().hits, 2)
+        for _ in range(2):  # invalid expressions are rejected on every use
+            self.assertRaises(xacro.XacroException, xacro.compile_expr, '"".__class__')
+
+    def test_compile_text(self):
+        self.assertEqual(xacro.compile_text('a $${b} ${c}$(arg d) $'),
+                         ((xacro.TEMPLATE_LITERAL, 'a ${b} '), (xacro.TEMPLATE_EXPR, 'c'),
+                          (xacro.TEMPLATE_EXTENSION, 'arg d'), (xacro.TEMPLATE_LITERAL, ' $')))
+        self.assertTrue(xacro.compile_text('${a}') is xacro.compile_text('${a}'))
+        self.assertEqual(xacro.compile_text(''), ())
+        self.assertRaises(xacro.XacroException, xacro.compile_text, 'a${')
+
+    def test_lexer(self):
+        lex = xacro.LEXER
+        text = 'a $${b} ${c}$(d)'
+        tokens = [(id, text[start:end]) for id, start, end in lex.scan(text)]
+        self.assertEqual(tokens, [(lex.TEXT, 'a '), (lex.DOLLAR_DOLLAR_BRACE, '$${'), (lex.TEXT, 'b} '),
+                                  (lex.EXPR, '${c}'), (lex.EXTENSION, '$(d)')])
+        self.assertRaises(xacro.XacroException, list, lex.scan('${'))
+        self.assertRaises(ValueError, xacro.QuickLexer, GROUP=r'(a)')
+
+    def test_macro_body_ir(self):
+        body = parseString('''<xacro:macro xmlns:xacro="http://www.ros.org/wiki/xacro" name="foo" params="x">
+<static a="1"><b/>text<!-- comment --></static><dynamic a="${x}"><static/></dynamic></xacro:macro>''').documentElement
+        ir = xacro.MacroBody(body)
+        for _ in range(2):
+            node = ir.instantiate()
+            self.assertFalse(node is body)
+            static, dynamic = [n for n in node.childNodes if n.nodeType == xml.dom.Node.ELEMENT_NODE]
+            self.assertTrue(getattr(static, 'xacro_static', False))
+            self.assertFalse(getattr(dynamic, 'xacro_static', False))
+            self.assertTrue(getattr(dynamic.firstChild, 'xacro_static', False))
+            self.assertTrue(xml_matches(node, body))
+
+    def test_mark_static(self):
+        doc = xacro.parse('''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+<b><c x="1"/>text</b><d x="${1}"><e/></d><f>${1}</f><g><xacro:if value="1"/></g><h><!-- xacro:eval-comments --></h></a>''')
+        a = doc.documentElement
+        static = dict((n.nodeName, getattr(n, 'xacro_static', False)) for n in a.getElementsByTagName('*'))
+        static.pop('xacro:if')
+        self.assertEqual(static, dict(b=True, c=False, d=False, e=True, f=False, g=False, h=False))
+        self.assertFalse(getattr(a, 'xacro_static', False))
+        self.assertTrue(getattr(xacro.parse('<a><b/></a>').documentElement, 'xacro_static', False))
+
+    def test_replace_node(self):
+        doc = parseString('<a><b/><c><d/>text<e/></c><f/></a>')
+        a = doc.documentElement
+        b, c, f = a.childNodes
+        xacro.replace_node(c, by=c, content_only=True)
+        self.assertEqual([n.nodeName for n in a.childNodes], ['b', 'd', '#text', 'e', 'f'])
+        self.assertTrue(all(n.parentNode is a for n in a.childNodes))
+        self.assertEqual([n.nodeName for n in a.childNodes[1:]],
+                         [n.nextSibling.nodeName for n in a.childNodes[:-1]])
+        self.assertEqual([n.nodeName for n in a.childNodes[:-1]],
+                         [n.previousSibling.nodeName for n in a.childNodes[1:]])
+        self.assertTrue(c.parentNode is None and not c.childNodes)
+        xacro.replace_node(b, by=None)
+        self.assertTrue(a.firstChild.nodeName == 'd' and a.firstChild.previousSibling is None)
+
     def test_tokenize_keep_empty(self):
         tokens = ' '.join(['ab', ' ', 'cd', 'ef'])
         results = xacro.tokenize(tokens, sep=' ', skip_empty=False)
@@ -559,6 +626,26 @@ class TestXacro(TestXacroCommentsIgnored):
         res = '''<a><f v="my_arg" /></a>'''
         self.assert_matches(self.quick_xacro('''<a><f v="$(arg sub_arg)" /></a>''', cli=['sub_arg:=my_arg']), res)
 
+    def test_substitution_args_resolve(self):
+        from xacro.substitution_args import resolve_args, SubstitutionException, _parse_args
+        context = {'arg': {'a': '1', 'b': '$(arg a)'}, 'filename': '/x/y.xacro'}
+        self.assertEqual(_parse_args('$(arg a)/$(dirname)'), (('arg a', 'arg', ('a',)), '/', ('dirname', 'dirname', ())))
+        self.assertEqual(resolve_args('$(arg a)/$(dirname) $(arg a)', context), '1//x 1')
+        self.assertEqual(resolve_args('$$(arg a) $() ) $(arg a', context), '$1 $() ) $(arg a')
+        # substituted values are not resolved again
+        self.assertEqual(resolve_args('$(arg b) $(arg a)', context), '$(arg a) 1')
+        for s in ['$(arg $(arg a))', '$(arg (a))', '$(foo)', '$( )']:
+            self.assertRaises(SubstitutionException, resolve_args, s, context)
+
+    def test_substitution_args_eval_cached(self):
+        from xacro.substitution_args import resolve_args, _compile_eval
+        _compile_eval.cache_clear()
+        for value in ['1', '2', '3']:
+            context = {'arg': {'x': value}, 'filename': '/x/y.xacro'}
+            self.assertEqual(resolve_args("$(eval arg('x') * 2 + x + pi - pi)", context), str(3.0 * int(value)))
+        self.assertEqual(resolve_args("$(eval dirname())", context), '/x')
+        self.assertEqual(_compile_eval.cache_info().misses, 2)
+
     def test_escaping_dollar_braces(self):
         src = '''<a b="$${foo}" c="$$${foo}" d="text $${foo}" e="text $$${foo}" f="$$(pwd)" />'''
         res = '''<a b="${foo}" c="$${foo}" d="text ${foo}" e="text $${foo}" f="$(pwd)" />'''
@@ -642,6 +729,23 @@ class TestXacro(TestXacroCommentsIgnored):
                           self.quick_xacro, '''<a xmlns:xacro="http://www.ros.org/xacro">
                              <xacro:include filename="include-nada.xml" /></a>''')
 
+    def test_include_cache(self):
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        filename = os.path.join(tmp_dir_name, 'inc.xml')
+        src = '''<a xmlns:xacro="http://www.ros.org/xacro">
+                   <xacro:include filename="{0}"/><xacro:include filename="{0}"/></a>'''.format(filename)
+        with open(filename, 'w') as f:
+            f.write('<a><inc1/></a>')
+        xacro.include_cache.clear()
+        self.assert_matches(self.quick_xacro(src), '<a><inc1/><inc1/></a>')
+        self.assertEqual((xacro.include_cache.hits, xacro.include_cache.misses), (1, 1))
+
+        with open(filename, 'w') as f:  # modifying the file invalidates the cache entry
+            f.write('<a><inc2/></a><!-- changed size -->')
+        self.assert_matches(self.quick_xacro(src), '<a><inc2/><inc2/></a>')
+        self.assertEqual((xacro.include_cache.hits, xacro.include_cache.misses), (2, 2))
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
     def test_include_deprecated(self):
         # <include> tags with some non-trivial content should not issue the deprecation warning
         src = '''<a><include filename="nada"><tag/></include></a>'''
@@ -1502,6 +1606,114 @@ included from: string
 </a>'''
         self.assertRaises(xacro.XacroException, self.quick_xacro, src.format(file=file))
 
+    def test_yaml_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'calibration.yaml')
+            with open(filename, 'w') as f:
+                f.write('joint: {offset: !degrees 90}\n')
+            xacro.yaml_cache.clear()
+            first = xacro.load_yaml(filename)
+            second = xacro.load_yaml(filename)
+            self.assertEqual(first.joint.offset, 0.5 * math.pi)
+            self.assertEqual(first, second)
+            self.assertEqual((xacro.yaml_cache.hits, xacro.yaml_cache.misses), (1, 1))
+            # modified files are loaded again
+            with open(filename, 'w') as f:
+                f.write('joint: {offset: !radians 0.25*pi, limit: 2}\n')
+            os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1))
+            self.assertEqual(xacro.load_yaml(filename).joint.limit, 2)
+            self.assertEqual(xacro.yaml_cache.misses, 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_yaml_wrappers_memoized(self):
+        raw = {'joints': [{'limits': {'effort': 1}}], 'name': 'a'}
+        data = xacro.YamlListWrapper.wrap_tree(raw)
+        self.assertIs(data.joints, data['joints'])
+        self.assertIs(data.joints[0].limits, data.joints[0].limits)
+        self.assertIs(next(iter(data.joints)), data.joints[0])
+        self.assertEqual(data.joints[0].limits.effort, 1)
+        self.assertRaises(xacro.XacroException, getattr, data.joints[0], 'nokey')
+        self.assertEqual(data, raw)
+        # structures shared via yaml aliases are wrapped once
+        shared = [1]
+        shared.append(shared)
+        wrapped = xacro.YamlListWrapper.wrap_tree(shared)
+        self.assertIs(wrapped[1], wrapped)
+        # wrapped trees are read-only, but can be copied
+        self.assertRaises(xacro.XacroException, data.joints.append, 2)
+        self.assertRaises(xacro.XacroException, data.update, name='b')
+        self.assertRaises(xacro.XacroException, data.joints[0].limits.__setitem__, 'effort', 2)
+        copied = dict(data)
+        copied['name'] = 'b'
+        self.assertEqual(data.name, 'a')
+        # dotify()'d data stays modifiable
+        dotified = xacro.YamlDictWrapper({'lst': [1]})
+        dotified['lst'].append(2)
+        self.assertEqual(dotified.lst, [1])
+
+    def test_yaml_cache_isolation(self):
+        # modifying cached yaml data must not leak into subsequently processed documents
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'data.yaml')
+            with open(filename, 'w') as f:
+                f.write('lst: [1, 2]\n')
+            src = '''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+  <xacro:property name="d" value="${{xacro.load_yaml('{}')}}"/>
+  <b n="${{len(d.lst)}}"/>
+</a>'''.format(filename)
+            modify = src.replace('<b ', '<c m="${d.lst.append(3)}"/><b ')
+            xacro.yaml_cache.clear()
+            for run in range(3):
+                with self.assertRaises(xacro.XacroException):
+                    self.quick_xacro(modify)
+                self.assert_matches(self.quick_xacro(src), '<a><b n="2"/></a>')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_load_indexed(self):
+        from xacro import lazyload
+        tmp_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        old_threshold = lazyload.INDEX_THRESHOLD
+        lazyload.INDEX_THRESHOLD = 10  # index all nested mappings
+        try:
+            data = {'label': u'grüße', 'links': {'base': {'mass': 2.5, 'size': [1, 2]}, 'arm': {'mass': 1}},
+                    'name': 'robot'}
+            with open(os.path.join(tmp_dir, 'robot.json'), 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1, ensure_ascii=False)
+            with open(os.path.join(tmp_dir, 'robot.yaml'), 'w', encoding='utf-8') as f:
+                f.write(u'label: grüße\nlinks:\n  base: {mass: 2.5, size: [1, 2]}\n'
+                        u'  arm:\n    mass: 1  # comment ä\nname: robot\n')
+            for filename in ['robot.json', 'robot.yaml']:
+                src = os.path.join(tmp_dir, filename + '.xacro')
+                with open(src, 'w') as f:
+                    f.write('''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+  <xacro:property name="d" value="${{xacro.load_{kind}('{file}', lazy=True)}}"/>
+  <link name="${{d.name}}" mass="${{d.links.base.mass}}" size="${{d.links.base.size[1]}}" keys="${{list(d.links)}}"/>
+</a>'''.format(kind=filename.split('.')[1], file=os.path.join(tmp_dir, filename)))
+                for run in range(3):  # 1st run without cache_dir, 3rd run uses the stored indexes
+                    xacro.yaml_cache.clear()
+                    doc = xacro.process_file(src, cache_dir=cache_dir if run else None)
+                    self.assert_matches(doc.getElementsByTagName('link')[0].toxml(),
+                                        '''<link name="robot" mass="2.5" size="2" keys="['base', 'arm']"/>''')
+                    # indexes are only stored on request
+                    index = lazyload.index_filename(cache_dir, os.path.join(tmp_dir, filename))
+                    self.assertEqual(os.path.exists(index), run > 0)
+                load = xacro.load_yaml if filename.endswith('.yaml') else xacro.load_json
+                doc = load(os.path.join(tmp_dir, filename), lazy=True)
+                self.assertIsInstance(doc.links, lazyload.IndexedDict)
+                self.assertRaises(xacro.XacroException, lambda: doc.links.foo)
+                self.assertEqual(doc, data)
+                self.assertEqual(len(doc.links), 2)
+                self.assertRaises(xacro.XacroException, doc.links.base.size.append, 3)
+            self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'index'))), 2)
+        finally:
+            lazyload.INDEX_THRESHOLD = old_threshold
+            shutil.rmtree(tmp_dir)
+
     def test_xacro_exist_required(self):
         src = '''
 <a xmlns:xacro="http://www.ros.org/wiki/xacro">
@@ -1609,11 +1821,484 @@ ${u'🍔' * how_many}
         self.assert_matches(xml.dom.minidom.parse(output_path), '''<robot>🍔</robot>''')
         shutil.rmtree(tmp_dir_name)  # clean up after ourselves
 
+    def test_batch_mode(self):
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        input_path = os.path.join(test_dir, 'emoji.xacro')
+        other_path = os.path.join(test_dir, 'subdir', 'include-recursive.xacro')
+        self.run_xacro(input_path, other_path, '-j', '2', '-o', tmp_dir_name)
+        self.assert_matches(xml.dom.minidom.parse(os.path.join(tmp_dir_name, 'emoji')), '<robot>🍔</robot>')
+        self.assertTrue(os.path.isfile(os.path.join(tmp_dir_name, 'include-recursive')))
+
+        # a failing input (processed first) doesn't stop processing of the remaining ones
+        missing_path = os.path.join(test_dir, 'non-existent.xacro')
+        for verbosity in [[], ['-vv']]:
+            os.remove(os.path.join(tmp_dir_name, 'emoji'))
+            code = subprocess.call(['xacro', missing_path, input_path, '-o', tmp_dir_name] + verbosity,
+                                   stderr=subprocess.DEVNULL)
+            self.assertEqual(code, 2)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir_name, 'emoji')))
+
+        # manifest with explicit, tab-separated output file (whose name contains spaces)
+        manifest = os.path.join(tmp_dir_name, 'manifest')
+        output_path = os.path.join(tmp_dir_name, 'sub dir', 'out put.xml')
+        with open(manifest, 'w') as f:
+            f.write('# comment\n\n%s\t%s\n' % (input_path, output_path))
+        self.run_xacro('--manifest', manifest)
+        self.assert_matches(xml.dom.minidom.parse(output_path), '<robot>🍔</robot>')
+        self.assertEqual(xacro.cli.load_manifest(manifest), [(input_path, output_path)])
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_generate_files(self):
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        input_path = os.path.join(test_dir, 'emoji.xacro')
+        jobs = [(input_path, os.path.join(tmp_dir_name, 'out%d.xml' % i)) for i in range(4)]
+        jobs.append((os.path.join(test_dir, 'non-existent.xacro'), os.path.join(tmp_dir_name, 'failed.xml')))
+        for max_workers in [1, 2]:
+            errors = xacro.generate_files(jobs, max_workers=max_workers)
+            self.assertEqual(errors[:-1], [None] * 4)
+            self.assertIn('non-existent.xacro', errors[-1])
+            for _, output_path in jobs[:-1]:
+                self.assert_matches(xml.dom.minidom.parse(output_path), '<robot>🍔</robot>')
+                os.remove(output_path)
+            self.assertFalse(os.path.exists(jobs[-1][1]))
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_server(self):
+        import time
+        from xacro.server import run_client
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        input_path = os.path.join(test_dir, 'emoji.xacro')
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        socket_path = os.path.join(tmp_dir_name, 'xacro.sock')
+        output_path = os.path.join(tmp_dir_name, 'out.xml')
+        opts = dict(output=output_path, just_deps=False, verbosity=1, mappings={})
+        self.assertIsNone(run_client(socket_path, input_path, opts))  # no server running yet
+        # the server requires an explicit socket, which clients use as well
+        env = dict((k, v) for k, v in os.environ.items() if k != 'XACRO_SOCKET')
+        self.assertEqual(subprocess.call(['xacro', '--serve'], env=env, stderr=subprocess.DEVNULL), 2)
+
+        server = subprocess.Popen(['xacro', '--serve', '--socket', socket_path])
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(run_client(socket_path, input_path, opts), 0)
+            self.assert_matches(xml.dom.minidom.parse(output_path), '<robot>🍔</robot>')
+            # the client writes the depfile from the files read by the server
+            depfile = os.path.join(tmp_dir_name, 'out.d')
+            include_path = os.path.join(test_dir, 'subdir', 'include-recursive.xacro')
+            os.remove(output_path)
+            self.assertEqual(run_client(socket_path, include_path, dict(opts, depfile=depfile)), 0)
+            self.assertTrue(os.path.isfile(output_path))
+            xacro.generate(include_path, output=output_path, depfile=depfile + '.expected')
+            with open(depfile) as f, open(depfile + '.expected') as expected:
+                self.assertEqual(f.read(), expected.read())
+            self.assertIsNone(run_client(socket_path, input_path, dict(opts, output=None, depfile=depfile)))
+            self.assertEqual(run_client(socket_path, os.path.join(test_dir, 'non-existent.xacro'), opts), 2)
+        finally:
+            server.terminate()
+            server.wait()
+        self.assertFalse(os.path.exists(socket_path))
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_server_concurrent_requests(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from xacro.server import handle_request
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        requests = []
+        for i in range(8):
+            cwd = os.path.join(tmp_dir_name, str(i))
+            os.mkdir(cwd)
+            with open(os.path.join(cwd, 'input.xacro'), 'w') as f:
+                f.write('<a xmlns:xacro="http://www.ros.org/wiki/xacro">%d $(env XACRO_TEST_SERVER)</a>' % i)
+            requests.append(dict(input='input.xacro', cwd=cwd, env=dict(os.environ, XACRO_TEST_SERVER=str(i)),
+                                 opts=dict(just_deps=False, verbosity=1, mappings={})))
+        # requests modify the process-wide cwd, environment, and stdout: they must not interfere
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(handle_request, requests))
+        for i, response in enumerate(responses):
+            self.assertEqual(response['code'], 0)
+            self.assert_matches(xml.dom.minidom.parseString(response['stdout']), '<a>%d %d</a>' % (i, i))
+        self.assertNotIn('XACRO_TEST_SERVER', os.environ)
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_watch_dependencies(self):
+        from xacro.watch import Dependencies
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        input_path = os.path.join(tmp_dir_name, 'input.xacro')
+        include_path = os.path.join(tmp_dir_name, 'include.xacro')
+        with open(input_path, 'w') as f:
+            f.write('''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+                <xacro:include filename="%s"/></a>''' % include_path)
+        with open(include_path, 'w') as f:
+            f.write('<a><inc1/></a>')
+        xacro.process_file(input_path)
+        ctx = xacro.current_context()
+        self.assertEqual(ctx.include_graph, {input_path: [include_path]})
+        deps = Dependencies([input_path] + ctx.all_includes, ctx.include_graph, ctx.substitution_args['consulted'])
+        self.assertEqual(deps.includers(include_path), [input_path])
+
+        # rewriting unchanged content is not considered a change
+        with open(include_path, 'w') as f:
+            f.write('<a><inc1/></a>')
+        os.utime(include_path, ns=(0, 0))
+        self.assertEqual(deps.wait(interval=0.01, timeout=0.05), [])
+        with open(include_path, 'w') as f:
+            f.write('<a><inc2/></a>')
+        self.assertEqual(deps.wait(interval=0.01, timeout=1), [include_path])
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_incremental_update(self):
+        from xacro.incremental import update
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        input_path = os.path.join(tmp_dir_name, 'input.xacro')
+        sensor_path = os.path.join(tmp_dir_name, 'sensor.xacro')
+        with open(input_path, 'w') as f:
+            f.write('''<robot xmlns:xacro="http://www.ros.org/wiki/xacro">
+  <xacro:property name="size" value="2"/>
+  <xacro:include filename="%s"/>
+  <xacro:macro name="link" params="name">
+    <link name="${name}"><xacro:sensor name="${name}_sensor"/></link>
+  </xacro:macro>
+  <!-- first sensor -->
+  <xacro:sensor name="a"/>
+  <xacro:link name="b"/>
+  <other value="${size}"/>
+  <xacro:unrelated/>
+</robot>''' % sensor_path)
+
+        def write_sensor(body, value=1):
+            with open(sensor_path, 'w') as f:
+                f.write('''<robot xmlns:xacro="http://www.ros.org/wiki/xacro">
+  <xacro:property name="value" value="%s"/>
+  <xacro:macro name="sensor" params="name">%s</xacro:macro>
+  <xacro:macro name="unrelated"><unrelated/></xacro:macro>
+</robot>''' % (value, body))
+
+        write_sensor('<sensor name="${name}" value="${value}"/>')
+        doc = xacro.process_file(input_path, provenance=True)
+        ctx = xacro.current_context()
+        self.assertEqual(len(ctx.provenance.calls), 3)
+
+        # changing a macro body only re-expands the calls affected
+        unrelated = doc.getElementsByTagName('unrelated')[0]
+        write_sensor('<!-- comment --><sensor name="${name}" size="${size*value}"/><extra/>')
+        doc = update(ctx, [sensor_path])
+        self.assertIsNotNone(doc)
+        self.assertIs(doc.getElementsByTagName('unrelated')[0], unrelated)
+        expected = xacro.process_file(input_path).toprettyxml(indent='  ')
+        self.assertEqual(doc.toprettyxml(indent='  '), expected)
+
+        # changing anything else requires processing from scratch
+        write_sensor('<!-- comment --><sensor name="${name}" size="${size*value}"/><extra/>', value=2)
+        self.assertIsNone(update(ctx, [sensor_path]))
+        self.assertIsNone(update(ctx, [input_path]))
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_scan_deps(self):
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        for input_path in [os.path.join(test_dir, 'robots', 'pr2', 'pr2.urdf.xacro'),
+                           os.path.join(test_dir, 'subdir', 'include-recursive.xacro')]:
+            self.assertTrue(xacro.scan_file(input_path))
+            deps = set(xacro.all_includes)
+            xacro.process_file(input_path)
+            self.assertEqual(deps, set(xacro.all_includes))
+
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        input_path = os.path.join(tmp_dir_name, 'input.xacro')
+        include_path = os.path.join(tmp_dir_name, 'include.xacro')
+        with open(include_path, 'w') as f:
+            f.write('<a/>')
+        # includes within macros require full processing
+        with open(input_path, 'w') as f:
+            f.write('''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+                <xacro:macro name="m"><xacro:include filename="%s"/></xacro:macro><xacro:m/></a>''' % include_path)
+        self.assertFalse(xacro.scan_file(input_path))
+        self.assertEqual(xacro.process(input_path, just_deps=True), include_path)
+        # includes depending on properties, args, and conditionals are resolved
+        with open(input_path, 'w') as f:
+            f.write('''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+                <xacro:arg name="dir" default="%s"/><xacro:property name="name" value="include"/>
+                <xacro:if value="${name == 'include'}"><xacro:include filename="$(arg dir)/${name}.xacro"/></xacro:if>
+                <xacro:unless value="true"><xacro:include filename="missing.xacro"/></xacro:unless></a>''' % tmp_dir_name)
+        self.assertTrue(xacro.scan_file(input_path))
+        self.assertEqual(xacro.process(input_path, just_deps=True), include_path)
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_depfile(self):
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        input_path = os.path.join(test_dir, 'subdir', 'include-recursive.xacro')
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        output_path = os.path.join(tmp_dir_name, 'out dir', 'out.xml')
+        depfile = os.path.join(tmp_dir_name, 'out.d')
+        xacro.generate(input_path, output=output_path, depfile=depfile)
+        with open(depfile) as f:
+            target, deps = f.read().split(': ', 1)
+        self.assertEqual(target, output_path.replace(' ', '\\ '))
+        deps = deps.replace('\\\n', '').split()
+        self.assertEqual(deps[0], input_path)
+        self.assertEqual(set(deps[1:]), set(os.path.abspath(f) for f in xacro.all_includes))
+
+        # output cache hits write the same depfile and provide the same context
+        with open(depfile) as f:
+            expected = f.read()
+        graph = xacro.current_context().include_graph
+        cache_dir = os.path.join(tmp_dir_name, 'cache')
+        for run in range(2):  # 2nd run is a cache hit
+            os.remove(depfile)
+            xacro.generate(input_path, output=output_path, depfile=depfile, cache_dir=cache_dir)
+            with open(depfile) as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(xacro.current_context().include_graph, graph)
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
+    def test_package_index(self):
+        from ament_index_python.packages import get_package_share_directory
+        from xacro.substitution_args import package_index, _eval_find
+        self.assertEqual(_eval_find('xacro'), get_package_share_directory('xacro'))
+        prefixes = package_index.prefixes
+        self.assertEqual(_eval_find('xacro'), get_package_share_directory('xacro'))
+        self.assertIs(package_index.prefixes, prefixes)  # index is reused
+        # changing AMENT_PREFIX_PATH invalidates the index
+        old = os.environ['AMENT_PREFIX_PATH']
+        os.environ['AMENT_PREFIX_PATH'] = old + os.pathsep + tempfile.gettempdir()
+        try:
+            self.assertEqual(_eval_find('xacro'), get_package_share_directory('xacro'))
+            self.assertIsNot(package_index.prefixes, prefixes)
+        finally:
+            os.environ['AMENT_PREFIX_PATH'] = old
+        self.assertRaises(Exception, _eval_find, 'non-existent-package')
+        with self.assertRaisesRegex(xacro.XacroException, 'package not found'):
+            xacro.eval_extension('$(find non-existent-package)')
+
+    def test_import_time(self):
+        # heavy dependencies are only loaded once needed
+        script = 'import sys, xacro; print(" ".join(sys.modules))'
+        modules = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True).split()
+        for module in ['yaml', 'ament_index_python', 'xacro.substitution_args', 'xacro.cache', 'xacro.cli']:
+            self.assertNotIn(module, modules)
+        # global symbols are created on first use
+        self.assertIs(xacro.global_symbols(), xacro.global_symbols())
+        self.assertIn('pi', xacro.global_symbols()['math'])
+
+    def test_clone_node(self):
+        from xacro.xmlutils import clone_node
+        doc = xacro.parse('''<a xmlns:xacro="http://www.ros.org/wiki/xacro" x="1">
+  <!-- comment --><xacro:b y="${2}" xacro:z="3">text<c/></xacro:b></a>''')
+        root = doc.documentElement
+        for deep in [True, False]:
+            clone = clone_node(root, deep)
+            self.assertEqual(clone.toxml(), root.cloneNode(deep).toxml())
+            self.assertIs(clone.ownerDocument, doc)
+        clone = clone_node(root)
+        b = clone.getElementsByTagName('xacro:b')[0]
+        self.assertEqual((b.namespaceURI, b.localName, b.getAttributeNS(b.namespaceURI, 'z')),
+                         ('http://www.ros.org/wiki/xacro', 'b', '3'))
+        b.setAttribute('y', 'changed')
+        b.firstChild.data = 'changed'
+        self.assertEqual(root.getElementsByTagName('xacro:b')[0].toxml(),
+                         '<xacro:b xacro:z="3" y="${2}">text<c/></xacro:b>')
+        self.assertIs(b.childNodes[1].previousSibling, b.firstChild)
+
+    def test_xml_backend(self):
+        from xacro import xmlutils
+        self.assertTrue(xmlutils._MINIDOM_INTERNALS)  # known to work with the tested python versions
+        src = '''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+  <xacro:macro name="m" params="x"><b x="${x}"><![CDATA[<d>]]></b></xacro:macro>
+  <xacro:m x="1"/><xacro:m x="2"/></a>'''
+        expected = '<a><b x="1"><![CDATA[<d>]]></b><b x="2"><![CDATA[<d>]]></b></a>'
+
+        # tree operations are delegated to the backend
+        class Backend(xmlutils.MinidomBackend):
+            calls = set()
+
+            def __getattribute__(self, name):
+                Backend.calls.add(name)
+                return object.__getattribute__(self, name)
+
+        old = xmlutils.set_backend(Backend())
+        try:
+            self.assert_matches(self.quick_xacro(src), expected)
+        finally:
+            xmlutils.set_backend(old)
+        self.assertTrue({'parse', 'clone_node', 'replace_node'}.issubset(Backend.calls))
+
+        # without access to minidom's internals, its public API is used
+        doc = xacro.parse(src)
+        xmlutils._MINIDOM_INTERNALS = False
+        try:
+            self.assertEqual(xmlutils.clone_node(doc.documentElement).toxml(), doc.documentElement.toxml())
+            self.assertEqual(xmlutils.pretty_xml(doc), doc.toprettyxml(indent='  '))
+            self.assert_matches(self.quick_xacro(src), expected)
+        finally:
+            xmlutils._MINIDOM_INTERNALS = True
+
+    def test_pretty_xml(self):
+        from xacro.xmlutils import pretty_xml, write_pretty_xml
+        doc = parseString('''<a x="&quot;&lt;&amp;&gt;" b=""><!--c--><?pi data?><![CDATA[x<y]]>
+  <b>t&amp;</b>  text &gt; <c/><d><![CDATA[z]]></d><e>
+  </e></a>''')
+        self.assertEqual(pretty_xml(doc), doc.toprettyxml(indent='  '))
+        self.assertEqual(pretty_xml(doc.documentElement, '\t'), doc.documentElement.toprettyxml(indent='\t'))
+        doc = xacro.process_file(os.path.join(os.path.dirname(__file__), 'robots', 'pr2', 'pr2.urdf.xacro'))
+
+        def depth(node):
+            return 0 if node.parentNode is None else 1 + depth(node.parentNode)
+
+        # nodes serialized via the fallback path, nested in deep elements with and without siblings
+        elements = sorted(doc.getElementsByTagName('*'), key=depth)
+        deepest, parent = elements[-1], elements[-1].parentNode
+        deepest.appendChild(doc.createCDATASection('a<b'))
+        deepest.appendChild(doc.createProcessingInstruction('pi', 'deep'))
+        parent.insertBefore(doc.createProcessingInstruction('pi', 'first'), parent.firstChild)
+        parent.appendChild(doc.createCDATASection(']]'))
+        self.assertGreater(depth(deepest), 3)
+        output = StringIO()
+        write_pretty_xml(doc, output, chunk_parts=10)
+        self.assertEqual(output.getvalue(), doc.toprettyxml(indent='  '))
+        self.assertIn('<![CDATA[a<b]]>', output.getvalue())
+        self.assertEqual(pretty_xml(doc), output.getvalue())
+
+    def test_process_streams_output(self):
+        # the command line streams the output in chunks, after processing succeeded
+        class Output(StringIO):
+            writes = 0
+
+            def write(self, s):
+                Output.writes += 1
+                return StringIO.write(self, s)
+
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        input_path = os.path.join(tmp_dir_name, 'input.xacro')
+        with open(input_path, 'w') as f:
+            f.write('<a>%s</a>' % ('<b x="1">text</b>' * 5000))
+        old, sys.stdout = sys.stdout, Output()
+        try:
+            xacro._process(input_path, dict(output=None, just_deps=False, verbosity=1, mappings={}))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old
+        self.assertGreater(Output.writes, 1)
+        self.assertEqual(output, xacro.xmlutils.pretty_xml(xacro.process_file(input_path)))
+
+        output_path = os.path.join(tmp_dir_name, 'out.xml')
+        old, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, xacro._process, os.path.join(tmp_dir_name, 'non-existent.xacro'),
+                              dict(output=output_path, just_deps=False, verbosity=1, mappings={}))
+        finally:
+            sys.stderr = old
+        self.assertFalse(os.path.exists(output_path))  # no (empty) output file on errors
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
     def test_process_return_value(self):
         test_dir = os.path.abspath(os.path.dirname(__file__))
         input_path = os.path.join(test_dir, 'emoji.xacro')
         self.assert_matches(xacro.process(input_path), '<robot>🍔</robot>')
 
+    def test_process_error(self):
+        # like the command line, process() reports errors and exits, while generate() raises
+        input_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'non-existent.xacro')
+        old, sys.stderr = sys.stderr, StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                xacro.process(input_path)
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = old
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('non-existent.xacro', output)
+        self.assertRaises(xacro.XacroException, xacro.generate, input_path)
+
+    def test_generate(self):
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        input_path = os.path.join(test_dir, 'emoji.xacro')
+        old, sys.stdout = sys.stdout, None  # any access to sys.stdout would fail
+        try:
+            result = xacro.generate(input_path)
+            writer = StringIO()
+            self.assertIsNone(xacro.generate(input_path, writer=writer))
+            mappings = {}
+            xacro.generate(input_path, mappings=mappings)
+            # errors are raised instead of exiting
+            self.assertRaises(xacro.XacroException, xacro.generate, os.path.join(test_dir, 'non-existent.xacro'))
+        finally:
+            sys.stdout = old
+        self.assertEqual(writer.getvalue(), result)
+        self.assertEqual(result, xacro.process_file(input_path).toprettyxml(indent='  '))
+        self.assertEqual(mappings, {})
+
+    def test_concurrent_processing(self):
+        from concurrent.futures import ThreadPoolExecutor
+        test_dir = os.path.abspath(os.path.dirname(__file__))
+        inputs = [os.path.join(test_dir, 'robots', 'pr2', 'pr2.urdf.xacro'),
+                  os.path.join(test_dir, 'emoji.xacro'),
+                  os.path.join(test_dir, 'subdir', 'include-recursive.xacro')] * 4
+
+        def run(input_path):
+            doc = xacro.process_file(input_path)
+            return doc.toprettyxml(indent='  '), sorted(set(xacro.all_includes))
+
+        expected = [run(f) for f in inputs]
+        with ThreadPoolExecutor(max_workers=len(inputs)) as executor:
+            self.assertEqual(list(executor.map(run, inputs)), expected)
+
+    def test_process_cache_dir(self):
+        tmp_dir_name = tempfile.mkdtemp()  # create directory we can trash
+        cache_dir = os.path.join(tmp_dir_name, 'cache')
+        input_path = os.path.join(tmp_dir_name, 'input.xacro')
+        include_path = os.path.join(tmp_dir_name, 'include.xacro')
+        with open(input_path, 'w') as f:
+            f.write('''<a xmlns:xacro="http://www.ros.org/wiki/xacro">
+                <xacro:include filename="include.xacro"/>$(optenv XACRO_TEST_CACHE)</a>''')
+        with open(include_path, 'w') as f:
+            f.write('<a><inc1/></a>')
+        self.assert_matches(xacro.process(input_path, cache_dir=cache_dir), '<a><inc1/></a>')
+
+        # tamper with the cached output to detect cache hits
+        outputs = [os.path.join(d, f) for d, _, files in os.walk(cache_dir) for f in files if f.endswith('.out')]
+        self.assertEqual(len(outputs), 1)
+        with open(outputs[0], 'w') as f:
+            f.write('<cached/>')
+        ctx = xacro.current_context()
+        self.assert_matches(xacro.process(input_path, cache_dir=cache_dir), '<cached/>')
+        # cache hits restore the include graph and consulted values (as used by --watch)
+        cached_ctx = xacro.current_context()
+        self.assertIsNot(cached_ctx, ctx)
+        self.assertEqual(cached_ctx.include_graph, ctx.include_graph)
+        self.assertEqual(cached_ctx.substitution_args['consulted'], ctx.substitution_args['consulted'])
+        self.assertIn(('env', 'XACRO_TEST_CACHE'), cached_ctx.substitution_args['consulted'])
+
+        # changing a consulted environment variable invalidates the cache entry
+        os.environ['XACRO_TEST_CACHE'] = 'env'
+        try:
+            self.assert_matches(xacro.process(input_path, cache_dir=cache_dir), '<a><inc1/>env</a>')
+        finally:
+            del os.environ['XACRO_TEST_CACHE']
+        # as does changing an included file
+        with open(include_path, 'w') as f:
+            f.write('<a><inc2/></a>')
+        self.assert_matches(xacro.process(input_path, cache_dir=cache_dir), '<a><inc2/></a>')
+
+        # warnings are re-emitted on cache hits
+        with open(include_path, 'w') as f:
+            f.write('<a xmlns:xacro="http://www.ros.org/wiki/xacro">${xacro.warning("from include")}</a>')
+        for run in range(2):
+            with capture_stderr(xacro.process, input_path, cache_dir=cache_dir) as (result, output):
+                self.assertIn('from include', output)
+
+        # the key depends on xacro's sources
+        key = xacro.cache.OutputCache.key(input_path, {}, False)
+        old_hash, xacro.cache.package_hash = xacro.cache.package_hash, lambda: 'modified'
+        try:
+            self.assertNotEqual(xacro.cache.OutputCache.key(input_path, {}, False), key)
+        finally:
+            xacro.cache.package_hash = old_hash
+        shutil.rmtree(tmp_dir_name)  # clean up after ourselves
+
     def test_invalid_syntax(self):
         self.assertRaises(xacro.XacroException, self.quick_xacro, '<a>a${</a>')
         self.assertRaises(xacro.XacroException, self.quick_xacro, '<a>${b</a>')
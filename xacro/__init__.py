@@ -31,34 +31,92 @@
 # Maintainer: Morgan Quigley <morgan@osrfoundation.org>
 
 import ast
+import functools
 import glob
+import importlib
 import math
 import os
 import re
 import sys
+import threading
+import types
 import xml.dom.minidom
+import xml.parsers.expat
 
 from copy import deepcopy
-from .cli import process_args
-from .color import error, message, warning
+from . import color
+from .color import error, message
+from . import xmlutils
 from .xmlutils import opt_attrs, reqd_attrs, first_child_element, \
     next_sibling_element, replace_node
 
 
-# Dictionary of substitution args
-substitution_args_context = {}
+# document providing the empty text node used by remove_previous_comments()
+_empty_text_doc = xml.dom.minidom.getDOMImplementation().createDocument(None, "dummy", None)
 
 
-# Stack of currently processed files / macros
-filestack = None
-macrostack = None
+class XacroContext(object):
+    """
+    Processing state of a xacro run.
+    Each thread processes documents within its own current context (see current_context()),
+    which allows to process several documents concurrently.
+    """
+
+    def __init__(self, filename=None, mappings=None, verbosity=1):
+        # Stack of currently processed files / macros
+        self.filestack = [filename]
+        self.macrostack = []
+        # All files read during processing and the include graph: file -> files read by it
+        self.all_includes = []
+        self.include_graph = {}
+        # Provenance of processed document, recorded for incremental updates (see incremental.py)
+        self.provenance = None
+        # Directory persisting caches across runs (see generate()) and lazyload.Sources to store indexes of
+        self.cache_dir = None
+        self.index_sources = set()
+        # Dictionary of substitution args and external values consulted to resolve them
+        self.substitution_args = {'arg': {} if mappings is None else mappings, 'consulted': {}}
+        self.verbosity = verbosity
+        # Warnings emitted during processing (re-emitted when reusing cached output)
+        self.warnings = []
+        # Text node inserted by remove_previous_comments() to stop removal of comments
+        self.empty_text_node = _empty_text_doc.createTextNode('\n\n')
+
+    def add_include(self, filename):
+        """Record filename as read by the currently processed file"""
+        self.all_includes.append(filename)
+        self.include_graph.setdefault(self.filestack[-1], []).append(filename)
+        if self.provenance is not None:
+            self.provenance.add_file(filename)
+
+
+_thread_state = threading.local()
+
+
+def current_context():
+    """Return the processing context of the current thread"""
+    try:
+        return _thread_state.context
+    except AttributeError:
+        return set_current_context(XacroContext())
+
+
+def set_current_context(ctx):
+    """Make ctx the processing context of the current thread"""
+    _thread_state.context = ctx
+    return ctx
+
+
+def warning(*args, **kwargs):
+    """Print a warning, recording it in the current context"""
+    current_context().warnings.append(' '.join(str(arg) for arg in args))
+    color.warning(*args, **kwargs)
 
 
 def init_stacks(file):
-    global filestack
-    global macrostack
-    filestack = [file]
-    macrostack = []
+    ctx = current_context()
+    ctx.filestack = [file]
+    ctx.macrostack = []
 
 
 def abs_filename_spec(filename_spec):
@@ -67,7 +125,7 @@ def abs_filename_spec(filename_spec):
     if filename_spec is not yet absolute
     """
     if not os.path.isabs(filename_spec):
-        parent_filename = filestack[-1]
+        parent_filename = current_context().filestack[-1]
         basedir = os.path.dirname(parent_filename) if parent_filename else '.'
         return os.path.join(basedir, filename_spec)
     return filename_spec
@@ -79,37 +137,91 @@ class YamlListWrapper(list):
     def wrap(item):
         """This static method, used by both YamlListWrapper and YamlDictWrapper,
            dispatches to the correct wrapper class depending on the type of yaml item"""
-        if isinstance(item, dict):
+        if isinstance(item, (YamlDictWrapper, YamlListWrapper)):  # already wrapped
+            return item
+        elif isinstance(item, dict):
             return YamlDictWrapper(item)
         elif isinstance(item, list):
             return YamlListWrapper(item)
         else:  # scalar
             return item
 
+    @staticmethod
+    def wrap_tree(item, memo=None):
+        """
+        Wrap item and all its descendants once, such that accessing them doesn't create new wrappers.
+        The resulting wrappers are read-only, as they are shared via yaml_cache.
+        """
+        if memo is None:
+            memo = {}
+        if not isinstance(item, (dict, list)):  # scalar
+            return item
+        try:  # item already visited (yaml aliases can share and even nest structures)
+            return memo[id(item)]
+        except KeyError:
+            pass
+        if isinstance(item, dict):
+            result = memo[id(item)] = ReadOnlyYamlDictWrapper()
+            for key, value in item.items():
+                dict.__setitem__(result, key, YamlListWrapper.wrap_tree(value, memo))
+        else:
+            result = memo[id(item)] = ReadOnlyYamlListWrapper()
+            list.extend(result, [YamlListWrapper.wrap_tree(value, memo) for value in item])
+        return result
+
     def __getitem__(self, idx):
-        return YamlListWrapper.wrap(super(YamlListWrapper, self).__getitem__(idx))
+        item = list.__getitem__(self, idx)
+        return item if type(item) in _yaml_final_types else YamlListWrapper.wrap(item)
 
     def __iter__(self):
-        for item in super(YamlListWrapper, self).__iter__():
-            yield YamlListWrapper.wrap(item)
+        for item in list.__iter__(self):
+            yield item if type(item) in _yaml_final_types else YamlListWrapper.wrap(item)
 
 
 class YamlDictWrapper(dict):
     """Wrapper class providing dotted access to dict items"""
     def __getattr__(self, item):
         try:
-            return YamlListWrapper.wrap(super(YamlDictWrapper, self).__getitem__(item))
+            value = dict.__getitem__(self, item)
         except KeyError:
             raise XacroException("No such key: '{}'".format(item))
+        return value if type(value) in _yaml_final_types else YamlListWrapper.wrap(value)
 
     __getitem__ = __getattr__
 
 
+def _read_only(self, *args, **kwargs):
+    raise XacroException("loaded yaml data is read-only; copy it first, e.g. using list() or dict()")
+
+
+class ReadOnlyYamlListWrapper(YamlListWrapper):
+    """YamlListWrapper of loaded yaml data, rejecting modifications"""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce__(self):  # copies are plain, modifiable lists
+        return list, (list(self),)
+
+
+class ReadOnlyYamlDictWrapper(YamlDictWrapper):
+    """YamlDictWrapper of loaded yaml data, rejecting modifications"""
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):  # copies are plain, modifiable dicts
+        return dict, (dict(self),)
+
+
+# types of yaml items that are returned as is, i.e. without (re)wrapping
+_yaml_final_types = frozenset([YamlDictWrapper, YamlListWrapper, ReadOnlyYamlDictWrapper, ReadOnlyYamlListWrapper,
+                               str, int, float, bool, type(None)])
+
+
 def construct_angle_radians(loader, node):
     """utility function to construct radian values from yaml"""
     value = loader.construct_scalar(node)
     try:
-        return float(safe_eval(value, _global_symbols))
+        return float(safe_eval(value, global_symbols()))
     except SyntaxError:
         raise XacroException("invalid expression: %s" % value)
 
@@ -119,24 +231,126 @@ def construct_angle_degrees(loader, node):
     return math.radians(construct_angle_radians(loader, node))
 
 
-def load_yaml(filename):
-    try:
+_yaml_loader = None
+
+
+def yaml_loader():
+    """Return the yaml loader class: libyaml's CSafeLoader if available, SafeLoader otherwise"""
+    global _yaml_loader
+    if _yaml_loader is None:
         import yaml
-        yaml.SafeLoader.add_constructor(u'!radians', construct_angle_radians)
-        yaml.SafeLoader.add_constructor(u'!degrees', construct_angle_degrees)
-    except Exception:
-        raise XacroException("yaml support not available; install python-yaml")
+        loader = type('XacroYamlLoader', (getattr(yaml, 'CSafeLoader', yaml.SafeLoader),), {})
+        loader.add_constructor(u'!radians', construct_angle_radians)
+        loader.add_constructor(u'!degrees', construct_angle_degrees)
+        _yaml_loader = loader
+    return _yaml_loader
+
+
+class YamlCache(object):
+    """
+    Process-wide cache of loaded yaml files.
+    Entries are keyed by absolute filename and validated against the file's size and mtime.
+    The loaded data is shared between all lookups and thus read-only (see YamlListWrapper.wrap_tree).
+    """
+
+    def __init__(self):
+        self.entries = {}  # (filename, kind) -> ((size, mtime), data)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self, filename, parse, kind='yaml'):
+        """Return the data loaded from filename, calling parse(filename) if it isn't cached yet"""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return parse(filename)  # let parse() report the error
+
+        key = (os.path.abspath(filename), kind)
+        stamp = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == stamp
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            entry = (stamp, parse(filename))
+            with self.lock:
+                self.entries[key] = entry
+        return entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+yaml_cache = YamlCache()
+
+
+def _load_file(filename, parse, kind):
+    """Load filename via yaml_cache, recording it as an include"""
+    ctx = current_context()
+
+    def parse_file(filename):
+        with open(filename) as f:
+            ctx.filestack.append(filename)
+            try:
+                return parse(f)
+            finally:
+                ctx.filestack.pop()
 
     filename = abs_filename_spec(filename)
-    f = open(filename)
-    filestack.append(filename)
     try:
-        return YamlListWrapper.wrap(yaml.safe_load(f))
+        return yaml_cache.load(filename, parse_file, kind)
+    finally:
+        ctx.add_include(filename)
+
+
+def _load_indexed(filename, source, kind):
+    """Load filename lazily from the lazyload.Source created by source(f), which is cached in yaml_cache"""
+    from .lazyload import load_indexed
+    ctx = current_context()
+    source = _load_file(filename, source, kind)
+    if ctx.cache_dir:  # use stored indexes, new ones are stored by process_file()
+        source.read_indexes(ctx.cache_dir)
+        ctx.index_sources.add(source)
+    ctx.filestack.append(source.filename)
+    try:
+        return load_indexed(source)
     finally:
-        f.close()
-        filestack.pop()
-        global all_includes
-        all_includes.append(filename)
+        ctx.filestack.pop()
+
+
+def load_yaml(filename, lazy=False):
+    """
+    Load a yaml file
+    :param lazy: only index the file's top-level mapping, loading values when accessed (for huge files)
+    """
+    try:
+        import yaml
+        loader = yaml_loader()
+    except Exception:
+        raise XacroException("yaml support not available; install python-yaml")
+
+    if lazy:
+        from .lazyload import YamlSource
+        return _load_indexed(filename, lambda f: YamlSource(f, loader), 'yaml-indexed')
+    return _load_file(filename, lambda f: YamlListWrapper.wrap_tree(yaml.load(f, Loader=loader)), 'yaml')
+
+
+def load_json(filename, lazy=False):
+    """
+    Load a json file
+    :param lazy: only index the file's top-level object, loading values when accessed (for huge files)
+    """
+    if lazy:
+        from .lazyload import JsonSource
+        return _load_indexed(filename, JsonSource, 'json-indexed')
+    import json
+    return _load_file(filename, lambda f: YamlListWrapper.wrap_tree(json.load(f)), 'json')
 
 
 def tokenize(s, sep=',; ', skip_empty=True):
@@ -202,7 +416,8 @@ def create_global_symbols():
     # Expose load_yaml, abs_filename, and dotify into namespace xacro (and directly with deprecation)
     expose(load_yaml=load_yaml, abs_filename=abs_filename_spec, dotify=YamlDictWrapper,
            ns='xacro', deprecate_msg=deprecate_msg)
-    expose(arg=lambda name: substitution_args_context['arg'][name], ns='xacro')
+    expose(load_json=load_json, ns='xacro')
+    expose(arg=lambda name: current_context().substitution_args['arg'][name], ns='xacro')
 
     def message_adapter(f):
         def wrapper(*args, **kwargs):
@@ -224,11 +439,26 @@ def create_global_symbols():
     return result
 
 
-def safe_eval(expr, globals, locals=None):
-    code = compile(expr.strip(), "<expression>", "eval")
+# Maximum number of compiled expressions kept in compile_expr's cache
+EXPRESSION_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expr(expr):
+    """
+    Compile and validate a (stripped) python expression.
+    Code objects are cached (LRU) across all documents processed by this interpreter.
+    Use compile_expr.cache_info() to inspect hits and misses, compile_expr.cache_clear() to reset.
+    """
+    code = compile(expr, "<expression>", "eval")
     invalid_names = [n for n in code.co_names if n.startswith("__")]
     if invalid_names:
         raise XacroException("Use of invalid name(s): ", ', '.join(invalid_names))
+    return code
+
+
+def safe_eval(expr, globals, locals=None):
+    code = compile_expr(expr.strip())
     globals.update(__builtins__= {})  # disable default builtins
     return eval(code, globals, locals)
 
@@ -251,9 +481,6 @@ class XacroException(Exception):
         return ' '.join([s for s in [str(e) for e in items] if s not in ['', 'None']])
 
 
-verbosity = 1
-
-
 def check_attrs(tag, required, optional):
     """
     Helper routine to fetch required and optional attributes
@@ -268,7 +495,7 @@ def check_attrs(tag, required, optional):
     extra = [a for a in tag.attributes.keys() if a not in allowed and not a.startswith("xmlns:")]
     if extra:
         warning("%s: unknown attribute(s): %s" % (tag.nodeName, ', '.join(extra)))
-        if verbosity > 0:
+        if current_context().verbosity > 0:
             print_location()
     return result
 
@@ -276,23 +503,123 @@ def check_attrs(tag, required, optional):
 class Macro(object):
     def __init__(self):
         self.body = None  # original xml.dom.Node
+        self.ir = None  # MacroBody, instantiated on each call
         self.params = []  # parsed parameter names
         self.defaultmap = {}  # default parameter values
         self.history = []  # definition history
 
 
+def is_static_element(elt):
+    """
+    Check whether an element itself (ignoring its children) doesn't require any xacro processing,
+    i.e. it is not a xacro tag and has neither xacro attributes nor $ substitutions in attribute values.
+    """
+    if elt.tagName.startswith('xacro:'):
+        return False
+    for name, value in elt.attributes.items():
+        if name.startswith('xacro:') or name == 'xmlns:xacro' or '$' in value:
+            return False
+    return True
+
+
+def is_static_node(node):
+    """Check whether a non-element node doesn't require any xacro processing"""
+    if node.nodeType == xml.dom.Node.TEXT_NODE:
+        return '$' not in node.data
+    elif node.nodeType == xml.dom.Node.COMMENT_NODE:
+        return 'xacro:eval-comments' not in node.data
+    return True  # all other node types are ignored by eval_all()
+
+
+def mark_static(node):
+    """
+    Pre-pass marking all maximal subtrees of node not requiring any xacro processing
+    as static (node.xacro_static), such that eval_all() can move them through untouched.
+    :return: whether node is static
+    """
+    if node.nodeType != xml.dom.Node.ELEMENT_NODE:
+        return is_static_node(node)
+
+    children = [(mark_static(child), child) for child in node.childNodes]
+    if is_static_element(node) and all(static for static, _ in children):
+        if node.parentNode is None or node.parentNode.nodeType == xml.dom.Node.DOCUMENT_NODE:
+            node.xacro_static = True  # no parent element will mark this node
+        return True
+
+    # node is dynamic: mark its static children
+    for static, child in children:
+        if static and child.nodeType == xml.dom.Node.ELEMENT_NODE:
+            child.xacro_static = True
+    return False
+
+
+# IR node types of MacroBody
+IR_STATIC, IR_ELEMENT, IR_NODE = range(3)
+
+
+class MacroBody(object):
+    """
+    Intermediate representation of a macro body, compiled once by grab_macro().
+    (IncludeCache uses the same representation for the root elements of cached include files.)
+    Subtrees not requiring any xacro processing are classified as static: they are cloned as is on
+    instantiation and marked as such (node.xacro_static) to be skipped by eval_all().
+    All other elements (including xacro tags like macro calls, conditionals, or block insertions)
+    are instantiated node by node and evaluated by eval_all() as usual.
+    """
+
+    def __init__(self, body):
+        self.ir, _ = self._compile(body)
+
+    @staticmethod
+    def _compile(node):
+        """Recursively compile node into its IR, returning (ir, is_static)"""
+        if node.nodeType == xml.dom.Node.ELEMENT_NODE:
+            children = [MacroBody._compile(child) for child in node.childNodes]
+            if is_static_element(node) and all(static for _, static in children):
+                return (IR_STATIC, node), True
+            return (IR_ELEMENT, node, tuple(ir for ir, _ in children)), False
+        return (IR_NODE, node), is_static_node(node)
+
+    def instantiate(self):
+        """Create a new copy of the macro body, ready for evaluation by eval_all()"""
+        return self._instantiate(self.ir)
+
+    @staticmethod
+    def _instantiate(ir):
+        if ir[0] == IR_STATIC:
+            node = xmlutils.backend.clone_node(ir[1], deep=True)
+            node.xacro_static = True
+        elif ir[0] == IR_ELEMENT:
+            node = xmlutils.backend.clone_node(ir[1], deep=False)
+            for child in ir[2]:
+                node.appendChild(MacroBody._instantiate(child))
+        else:
+            node = xmlutils.backend.clone_node(ir[1], deep=False)
+        return node
+
+
+def record_consulted(kind, name, value):
+    """Record an external value consulted during processing (allowing validation of cached output)"""
+    current_context().substitution_args['consulted'][(kind, name)] = value
+
+
 def eval_extension(s):
     if s == '$(cwd)':
+        record_consulted('cwd', '', os.getcwd())
         return os.getcwd()
     try:
-        from .substitution_args import resolve_args, ArgException, PackageNotFoundError
-        return resolve_args(s, context=substitution_args_context)
+        from .substitution_args import resolve_args, ArgException
+        return resolve_args(s, context=current_context().substitution_args)
     except ImportError as e:
         raise XacroException("substitution args not supported: ", exc=e)
     except ArgException as e:
         raise XacroException("Undefined substitution argument", exc=e)
-    except PackageNotFoundError as e:
-        raise XacroException("package not found:", exc=e)
+    except Exception as e:
+        # ament_index_python is only imported once a package was looked up: don't import it here
+        packages = sys.modules.get('ament_index_python.packages')
+        if packages is not None and isinstance(e, packages.PackageNotFoundError):
+            raise XacroException("package not found:", exc=e)
+        raise
 
 
 class Table(dict):
@@ -343,9 +670,10 @@ class Table(dict):
 
         # return evaluated result
         value = dict.__getitem__(self, key)
-        if (verbosity > 2 and self.parent is self.root) or verbosity > 3:
+        ctx = current_context()
+        if (ctx.verbosity > 2 and self.parent is self.root) or ctx.verbosity > 3:
             print("{indent}use {key}: {value} ({loc})".format(
-                indent=self.depth * ' ', key=key, value=value, loc=filestack[-1]), file=sys.stderr)
+                indent=self.depth * ' ', key=key, value=value, loc=ctx.filestack[-1]), file=sys.stderr)
         return value
 
     def __getitem__(self, key):
@@ -367,9 +695,10 @@ class Table(dict):
         elif key in self.unevaluated:
             # all other types cannot be evaluated
             self.unevaluated.remove(key)
-        if (verbosity > 2 and self.parent is self.root) or verbosity > 3:
+        ctx = current_context()
+        if (ctx.verbosity > 2 and self.parent is self.root) or ctx.verbosity > 3:
             print("{indent}set {key}: {value} ({loc})".format(
-                indent=self.depth * ' ', key=key, value=value, loc=filestack[-1]), file=sys.stderr)
+                indent=self.depth * ' ', key=key, value=value, loc=ctx.filestack[-1]), file=sys.stderr)
 
     def __setitem__(self, key, value):
         self._setitem(key, value, unevaluated=True)
@@ -414,21 +743,46 @@ class NameSpace(Table):
 
 
 class QuickLexer(object):
+    """
+    Single-pass lexer: all token patterns (given as NAME=regex keyword args) are combined
+    into a single alternation regex, trying the patterns in order of definition.
+    The input is scanned by position, without re-slicing the remaining string after each token.
+    Token ids are available as attributes NAME of the lexer.
+    """
     def __init__(self, *args, **kwargs):
         if args:
             # copy attributes + variables from other instance
             other = args[0]
             self.__dict__.update(other.__dict__)
         else:
-            self.res = []
+            patterns = []
             for k, v in kwargs.items():
-                self.__setattr__(k, len(self.res))
-                self.res.append(re.compile(v))
+                if re.compile(v).groups:
+                    raise ValueError('lexer pattern %s must not contain capturing groups' % k)
+                self.__setattr__(k, len(patterns))
+                patterns.append('({})'.format(v))
+            self.regex = re.compile('|'.join(patterns))
         self.str = ""
+        self.pos = 0
         self.top = None
 
+    def scan(self, str):
+        """
+        Generator yielding (id, start, end) for all consecutive tokens of str
+        :raise XacroException: if some part of str doesn't match any token
+        """
+        pos, end = 0, len(str)
+        match = self.regex.match
+        while pos < end:
+            m = match(str, pos)
+            if m is None:
+                raise XacroException('invalid expression: ' + str[pos:])
+            yield m.lastindex - 1, pos, m.end()
+            pos = m.end()
+
     def lex(self, str):
         self.str = str
+        self.pos = 0
         self.top = None
         self.next()
 
@@ -438,18 +792,16 @@ class QuickLexer(object):
     def next(self):
         result = self.top
         self.top = None
-        if not self.str:  # empty string
+        if self.pos >= len(self.str):  # end of string
             return result
-        for i in range(len(self.res)):
-            m = self.res[i].match(self.str)
-            if m:
-                self.top = (i, m.group(0))
-                self.str = self.str[m.end():]
-                return result
-        raise XacroException('invalid expression: ' + self.str)
+        m = self.regex.match(self.str, self.pos)
+        if m is None:
+            raise XacroException('invalid expression: ' + self.str[self.pos:])
+        self.top = (m.lastindex - 1, m.group(0))
+        self.pos = m.end()
+        return result
 
 
-all_includes = []
 include_no_matches_msg = """Include tag's filename spec \"{}\" matched no files."""
 
 
@@ -465,6 +817,7 @@ def get_include_files(filename_spec, symbols):
     if re.search('[*[?]+', filename_spec):
         # Globbing behaviour
         filenames = sorted(glob.glob(filename_spec))
+        record_consulted('glob', filename_spec, filenames)
         if len(filenames) == 0:
             warning(include_no_matches_msg.format(filename_spec))
     else:
@@ -472,11 +825,60 @@ def get_include_files(filename_spec, symbols):
         filenames = [filename_spec]
 
     for filename in filenames:
-        global all_includes
-        all_includes.append(filename)
+        current_context().add_include(filename)
         yield filename
 
 
+class IncludeCache(object):
+    """
+    Process-wide cache of parsed include files.
+    Entries are keyed by absolute filename and validated against the file's size and mtime.
+    Each lookup hands out a fresh copy of the document's root element.
+    """
+
+    def __init__(self):
+        self.entries = {}  # filename -> ((size, mtime), MacroBody)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def parse(self, filename):
+        """Return a copy of the root element of the parsed file"""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return parse(None, filename).documentElement  # let parse() report the error
+
+        key = os.path.abspath(filename)
+        stamp = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == stamp
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            entry = (stamp, MacroBody(parse(None, filename).documentElement))
+            with self.lock:
+                self.entries[key] = entry
+        return entry[1].instantiate()
+
+    def cached_root(self, filename):
+        """Return the (not to be modified) cached root element of filename, regardless of its validity"""
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(filename))
+        return entry[1].ir[1] if entry is not None else None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+include_cache = IncludeCache()
+
+
 def import_xml_namespaces(parent, attributes):
     """import all namespace declarations into parent"""
     for name, value in attributes.items():
@@ -486,12 +888,13 @@ def import_xml_namespaces(parent, attributes):
                 warning("inconsistent namespace redefinitions for {name}:"
                         "\n old: {old}\n new: {new} ({new_file})".format(
                             name=name, old=oldAttr.value, new=value,
-                            new_file=filestack[-1]))
+                            new_file=current_context().filestack[-1]))
             else:
                 parent.setAttribute(name, value)
 
 
 def process_include(elt, macros, symbols, func):
+    ctx = current_context()
     included = []
     filename_spec, namespace_spec, optional = check_attrs(elt, ['filename'], ['ns', 'optional'])
     if namespace_spec:
@@ -509,14 +912,14 @@ def process_include(elt, macros, symbols, func):
 
     if first_child_element(elt):
         warning("Child elements of a <xacro:include> tag are ignored")
-        if verbosity > 0:
+        if ctx.verbosity > 0:
             print_location()
 
     for filename in get_include_files(filename_spec, symbols):
         try:
             # extend filestack
-            filestack.append(filename)
-            include = parse(None, filename).documentElement
+            ctx.filestack.append(filename)
+            include = include_cache.parse(filename)
 
             # recursive call to func
             func(include, ns_macros, ns_symbols)
@@ -524,7 +927,7 @@ def process_include(elt, macros, symbols, func):
             import_xml_namespaces(elt.parentNode, include.attributes)
 
             # restore filestack
-            filestack.pop()
+            ctx.filestack.pop()
         except XacroException as e:
             if e.exc and isinstance(e.exc, IOError) and optional is True:
                 continue
@@ -533,7 +936,7 @@ def process_include(elt, macros, symbols, func):
 
     remove_previous_comments(elt)
     # replace the include tag with the nodes of the included file(s)
-    replace_node(elt, by=included, content_only=True)
+    xmlutils.backend.replace_node(elt, by=included, content_only=True)
 
 
 def is_valid_name(name):
@@ -599,8 +1002,9 @@ def grab_macro(elt, macros):
     # fetch existing or create new macro definition
     macro = macros.get(name, Macro())
     # append current filestack to history
-    macro.history.append(deepcopy(filestack))
+    macro.history.append(deepcopy(current_context().filestack))
     macro.body = elt
+    macro.ir = MacroBody(elt)
 
     # parse params and their defaults
     macro.params = []
@@ -612,7 +1016,7 @@ def grab_macro(elt, macros):
             macro.defaultmap[param] = value  # parameter with default
 
     macros[name] = macro
-    replace_node(elt, by=None)
+    xmlutils.backend.replace_node(elt, by=None)
 
 
 def grab_property(elt, table):
@@ -632,7 +1036,7 @@ def grab_property(elt, table):
 
     if remove and name in table:
         del table[name]
-        replace_node(elt, by=None)
+        xmlutils.backend.replace_node(elt, by=None)
         return
 
     if default is not None:
@@ -641,14 +1045,14 @@ def grab_property(elt, table):
         if name not in table:
             value = default
         else:
-            replace_node(elt, by=None)
+            xmlutils.backend.replace_node(elt, by=None)
             return
 
     if value is None:
         name = '**' + name
         value = elt  # debug
 
-    replace_node(elt, by=None)
+    xmlutils.backend.replace_node(elt, by=None)
 
     # We use lazy evaluation by default
     lazy_eval = get_boolean_value(eval_text(lazy_eval or 'true', table), lazy_eval)
@@ -676,14 +1080,50 @@ def grab_property(elt, table):
     target_table._setitem(name, value, unevaluated=lazy_eval)
 
 
-LEXER = QuickLexer(DOLLAR_DOLLAR_BRACE=r"^\$\$+(\{|\()",  # multiple $ in a row, followed by { or (
-                   EXPR=r"^\$\{[^\}]*\}",        # stuff starting with ${
-                   EXTENSION=r"^\$\([^\)]*\)",   # stuff starting with $(
+LEXER = QuickLexer(DOLLAR_DOLLAR_BRACE=r"\$\$+(?:\{|\()",  # multiple $ in a row, followed by { or (
+                   EXPR=r"\$\{[^\}]*\}",        # stuff starting with ${
+                   EXTENSION=r"\$\([^\)]*\)",   # stuff starting with $(
                    TEXT=r"[^$]+|\$[^{($]+|\$$")  # any text w/o $  or  $ following any chars except {($  or  single $
 
 
+# Maximum number of compiled text templates kept in compile_text's cache
+TEMPLATE_CACHE_SIZE = 4096
+
+# segment types of a compiled text template
+TEMPLATE_LITERAL, TEMPLATE_EXPR, TEMPLATE_EXTENSION = range(3)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_text(text):
+    """
+    Split text into an immutable tuple of (segment type, value) pairs:
+    TEMPLATE_LITERAL for plain text (including unescaped $$ sequences),
+    TEMPLATE_EXPR for the contents of ${...} and TEMPLATE_EXTENSION for the contents of $(...).
+    Templates are cached by text, such that each string is lexed only once.
+    """
+    segments = []
+    for id, start, end in LEXER.scan(text):
+        if id == LEXER.EXPR:
+            segments.append((TEMPLATE_EXPR, text[start + 2:end - 1]))
+            continue
+        elif id == LEXER.EXTENSION:
+            segments.append((TEMPLATE_EXTENSION, text[start + 2:end - 1]))
+            continue
+        elif id == LEXER.DOLLAR_DOLLAR_BRACE:
+            start += 1  # drop escaping $
+        value = text[start:end]
+        # merge consecutive literals
+        if segments and segments[-1][0] == TEMPLATE_LITERAL:
+            value = segments.pop()[1] + value
+        segments.append((TEMPLATE_LITERAL, value))
+    return tuple(segments)
+
+
 # evaluate text and return typed value
 def eval_text(text, symbols):
+    if '$' not in text:
+        return text  # fast path: plain text without any substitutions
+
     def handle_expr(s):
         try:
             return safe_eval(eval_text(s, symbols), symbols)
@@ -696,18 +1136,13 @@ def eval_text(text, symbols):
         return eval_extension("$(%s)" % eval_text(s, symbols))
 
     results = []
-    lex = QuickLexer(LEXER)
-    lex.lex(text)
-    while lex.peek():
-        id = lex.peek()[0]
-        if id == lex.EXPR:
-            results.append(handle_expr(lex.next()[1][2:-1]))
-        elif id == lex.EXTENSION:
-            results.append(handle_extension(lex.next()[1][2:-1]))
-        elif id == lex.TEXT:
-            results.append(lex.next()[1])
-        elif id == lex.DOLLAR_DOLLAR_BRACE:
-            results.append(lex.next()[1][1:])
+    for id, value in compile_text(text):
+        if id == TEMPLATE_EXPR:
+            results.append(handle_expr(value))
+        elif id == TEMPLATE_EXTENSION:
+            results.append(handle_extension(value))
+        else:
+            results.append(value)
     # return single element as is, i.e. typed
     if len(results) == 1:
         return results[0]
@@ -772,12 +1207,16 @@ def handle_macro_call(node, macros, symbols):
     name = node.tagName[6:]  # drop 'xacro:' prefix
     try:
         macros, symbols, m = resolve_macro(name, macros, symbols)
-        body = m.body.cloneNode(deep=True)
+        body = m.ir.instantiate()
 
     except KeyError:
         raise XacroException("unknown macro name: %s" % node.tagName)
 
-    macrostack.append(m)
+    ctx = current_context()
+    call = ctx.provenance and ctx.provenance.begin_call(
+        node, macros, symbols, m, ctx,
+        toplevel=not ctx.macrostack and len(ctx.filestack) == 1 and symbols.parent is global_symbols())
+    ctx.macrostack.append(m)
 
     # Expand the macro
     scoped_symbols = Table(symbols)  # new local name space for macro evaluation
@@ -823,14 +1262,17 @@ def handle_macro_call(node, macros, symbols):
 
     eval_all(body, scoped_macros, scoped_symbols)
 
+    if call:
+        ctx.provenance.end_call(call, body.childNodes, ctx)
+
     # Remove any comments directly before the macro call
     remove_previous_comments(node)
     # Lift all namespace attributes from the expanded body node to node's parent
     import_xml_namespaces(node.parentNode, body.attributes)
     # Replaces the macro node with the expansion
-    replace_node(node, by=body, content_only=True)
+    xmlutils.backend.replace_node(node, by=body, content_only=True)
 
-    macrostack.pop()
+    ctx.macrostack.pop()
     return True
 
 
@@ -861,11 +1303,9 @@ def get_boolean_value(value, condition):
                              "which is not a boolean expression." % (condition, value))
 
 
-_empty_text_node = xml.dom.minidom.getDOMImplementation().createDocument(None, "dummy", None).createTextNode('\n\n')
-
-
 def remove_previous_comments(node):
     """remove consecutive comments in front of the xacro-specific node"""
+    empty_text_node = current_context().empty_text_node
     next = node.nextSibling
     previous = node.previousSibling
     while previous:
@@ -880,13 +1320,16 @@ def remove_previous_comments(node):
         else:
             # insert empty text node to stop removing of comments in future calls
             # actually this moves the singleton instance to the new location
-            if next and _empty_text_node != next:
-                node.parentNode.insertBefore(_empty_text_node, next)
+            if next and empty_text_node != next:
+                node.parentNode.insertBefore(empty_text_node, next)
             return
 
 
 def eval_all(node, macros, symbols):
     """Recursively evaluate node, expanding macros, replacing properties, and evaluating expressions"""
+    if getattr(node, 'xacro_static', False):
+        return  # static subtree doesn't need any processing
+
     # evaluate the attributes
     for name, value in node.attributes.items():
         if name.startswith('xacro:'):  # remove xacro:* attributes
@@ -896,10 +1339,8 @@ def eval_all(node, macros, symbols):
             node.setAttribute(name, result)
 
     # remove xacro namespace definition
-    try:
+    if node.hasAttribute('xmlns:xacro'):
         node.removeAttribute('xmlns:xacro')
-    except xml.dom.NotFoundErr:
-        pass
 
     node = node.firstChild
     eval_comments = False
@@ -922,10 +1363,12 @@ def eval_all(node, macros, symbols):
                     raise XacroException("Undefined block \"%s\"" % name)
 
                 # cloning block allows to insert the same block multiple times
-                block = block.cloneNode(deep=True)
+                static = getattr(block, 'xacro_static', False)
+                block = xmlutils.backend.clone_node(block, deep=True)
+                block.xacro_static = static
                 # recursively evaluate block
                 eval_all(block, macros, symbols)
-                replace_node(node, by=block, content_only=content_only)
+                xmlutils.backend.replace_node(node, by=block, content_only=content_only)
 
             elif node.tagName == 'xacro:include':
                 process_include(node, macros, symbols, eval_all)
@@ -938,11 +1381,12 @@ def eval_all(node, macros, symbols):
 
             elif node.tagName == 'xacro:arg':
                 name, default = check_attrs(node, ['name', 'default'], [])
-                if name not in substitution_args_context['arg']:
-                    substitution_args_context['arg'][name] = str(eval_text(default, symbols))
+                args = current_context().substitution_args['arg']
+                if name not in args:
+                    args[name] = str(eval_text(default, symbols))
 
                 remove_previous_comments(node)
-                replace_node(node, by=None)
+                xmlutils.backend.replace_node(node, by=None)
 
             elif node.tagName == 'xacro:element':
                 name = eval_text(*reqd_attrs(node, ['xacro:name']), symbols=symbols)
@@ -959,7 +1403,7 @@ def eval_all(node, macros, symbols):
                     raise XacroException("xacro:attribute: empty name")
 
                 node.parentNode.setAttribute(name, value)
-                replace_node(node, by=None)
+                xmlutils.backend.replace_node(node, by=None)
 
             elif node.tagName in ['xacro:if', 'xacro:unless']:
                 remove_previous_comments(node)
@@ -970,9 +1414,9 @@ def eval_all(node, macros, symbols):
 
                 if keep:
                     eval_all(node, macros, symbols)
-                    replace_node(node, by=node, content_only=True)
+                    xmlutils.backend.replace_node(node, by=node, content_only=True)
                 else:
-                    replace_node(node, by=None)
+                    xmlutils.backend.replace_node(node, by=None)
 
             elif handle_macro_call(node, macros, symbols):
                 pass  # handle_macro_call does all the work of expanding the macro
@@ -988,7 +1432,7 @@ def eval_all(node, macros, symbols):
         elif node.nodeType == xml.dom.Node.COMMENT_NODE:
             if "xacro:eval-comments" in node.data:
                 eval_comments = "xacro:eval-comments:off" not in node.data
-                replace_node(node, by=None) # drop this comment
+                xmlutils.backend.replace_node(node, by=None) # drop this comment
             elif eval_comments:
                 node.data = str(eval_text(node.data, symbols))
             else:
@@ -997,6 +1441,90 @@ def eval_all(node, macros, symbols):
         node = next
 
 
+class FullEvaluationRequired(Exception):
+    """Raised by scan_deps() if it cannot determine all dependencies without full evaluation"""
+    pass
+
+
+# functions reading files from within expressions
+_FILE_LOADERS = ('load_yaml', 'load_json')
+
+
+def _check_no_file_loaders(text):
+    if any(loader in text for loader in _FILE_LOADERS):
+        raise FullEvaluationRequired()
+
+
+def scan_deps(node, macros, symbols):
+    """
+    Variant of eval_all() evaluating only what is needed to determine the files read during processing:
+    includes, properties, args, and conditionals. Macro calls, regular elements and text are not evaluated.
+    Raises FullEvaluationRequired for constructs that might read files or change the evaluation
+    of includes in a way not captured by the scan, e.g. includes within macros.
+    """
+    if getattr(node, 'xacro_static', False):
+        return  # static subtree doesn't need any processing
+
+    for _, value in node.attributes.items():
+        _check_no_file_loaders(value)
+
+    node = node.firstChild
+    while node:
+        next = node.nextSibling
+        if node.nodeType == xml.dom.Node.ELEMENT_NODE:
+            if node.tagName == 'xacro:include':
+                process_include(node, macros, symbols, scan_deps)
+
+            elif node.tagName == 'xacro:property':
+                for _, value in node.attributes.items():
+                    _check_no_file_loaders(value)
+                grab_property(node, symbols)
+
+            elif node.tagName == 'xacro:macro':
+                # macros are not expanded: their bodies must not influence the files read
+                body = node.toxml()
+                if any(s in body for s in ('xacro:include', 'xacro:arg', 'scope=') + _FILE_LOADERS):
+                    raise FullEvaluationRequired()
+                grab_macro(node, macros)
+
+            elif node.tagName == 'xacro:arg':
+                name, default = check_attrs(node, ['name', 'default'], [])
+                args = current_context().substitution_args['arg']
+                if name not in args:
+                    args[name] = str(eval_text(default, symbols))
+                xmlutils.backend.replace_node(node, by=None)
+
+            elif node.tagName in ['xacro:if', 'xacro:unless']:
+                cond, = check_attrs(node, ['value'], [])
+                keep = get_boolean_value(eval_text(cond, symbols), cond)
+                if node.tagName == 'xacro:unless':
+                    keep = not keep
+                if keep:
+                    scan_deps(node, macros, symbols)
+
+            elif node.tagName in ['xacro:insert_block', 'xacro:call']:
+                raise FullEvaluationRequired()
+
+            elif node.tagName.startswith('xacro:') and node.tagName not in ['xacro:element', 'xacro:attribute']:
+                # macro call: just check that it is a known macro without includes in its blocks
+                try:
+                    resolve_macro(node.tagName[6:], macros, symbols)
+                except KeyError:
+                    raise FullEvaluationRequired()
+                if node.getElementsByTagName('xacro:include'):
+                    raise FullEvaluationRequired()
+                for _, value in node.attributes.items():
+                    _check_no_file_loaders(value)
+
+            else:
+                scan_deps(node, macros, symbols)
+
+        elif node.nodeType in [xml.dom.Node.TEXT_NODE, xml.dom.Node.COMMENT_NODE]:
+            _check_no_file_loaders(node.data)
+
+        node = next
+
+
 def parse(inp, filename=None):
     """
     Parse input or filename into a DOM tree.
@@ -1012,34 +1540,35 @@ def parse(inp, filename=None):
             inp = f = open(filename)
         except IOError as e:
             # do not report currently processed file as "in file ..."
-            filestack.pop()
+            current_context().filestack.pop()
             raise XacroException(e.strerror + ": " + e.filename, exc=e)
 
     try:
-        if isinstance(inp, str):
-            return xml.dom.minidom.parseString(inp)
-        elif hasattr(inp, 'read'):
-            return xml.dom.minidom.parse(inp)
-        return inp
+        if isinstance(inp, str) or hasattr(inp, 'read'):
+            doc = xmlutils.backend.parse(inp)
+        else:
+            return inp
+        mark_static(doc.documentElement)
+        return doc
 
     finally:
         if f:
             f.close()
 
 
-def process_doc(doc, mappings=None, **kwargs):
-    global verbosity
-    verbosity = kwargs.get('verbosity', verbosity)
+def process_doc(doc, mappings=None, evaluate=eval_all, **kwargs):
+    ctx = current_context()
+    ctx.verbosity = kwargs.get('verbosity', ctx.verbosity)
 
     # set substitution args
-    substitution_args_context['arg'] = {} if mappings is None else mappings
+    ctx.substitution_args['arg'] = {} if mappings is None else mappings
 
     # if not yet defined: initialize filestack
-    if not filestack:
+    if not ctx.filestack:
         init_stacks(None)
 
     macros = Table()
-    symbols = Table(_global_symbols)
+    symbols = Table(global_symbols())
 
     # apply xacro:targetNamespace as global xmlns (if defined)
     targetNS = doc.documentElement.getAttribute('xacro:targetNamespace')
@@ -1047,10 +1576,10 @@ def process_doc(doc, mappings=None, **kwargs):
         doc.documentElement.removeAttribute('xacro:targetNamespace')
         doc.documentElement.setAttribute('xmlns', targetNS)
 
-    eval_all(doc.documentElement, macros, symbols)
+    evaluate(doc.documentElement, macros, symbols)
 
     # reset substitution args
-    substitution_args_context['arg'] = {}
+    ctx.substitution_args['arg'] = {}
 
 
 def open_output(output_filename):
@@ -1072,16 +1601,32 @@ def open_output(output_filename):
             raise XacroException("Failed to open output:", exc=e)
 
 
+def write_depfile(filename, targets, deps):
+    """Write a Makefile (or Ninja) compatible depfile, declaring that targets depend on deps"""
+    def escape(path):
+        return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+    # use absolute paths: tools interpret relative ones w.r.t. different directories
+    deps = list(dict.fromkeys(os.path.abspath(d) for d in deps))  # remove duplicates, but keep order
+    try:
+        with open(filename, 'w') as f:
+            f.write('%s: %s\n' % (' '.join(escape(t) for t in targets),
+                                  ' \\\n  '.join(escape(d) for d in deps)))
+    except IOError as e:
+        raise XacroException("Failed to write depfile:", exc=e)
+
+
 def print_location():
+    ctx = current_context()
     msg = 'when instantiating macro:'
-    for m in reversed(macrostack or []):
+    for m in reversed(ctx.macrostack or []):
         name = m.body.getAttribute('name')
         location = '({file})'.format(file = m.history[-1][-1] or '???')
         print(msg, name, location, file=sys.stderr)
         msg = 'instantiated from:'
 
-    msg = 'in file:' if macrostack else 'when processing file:'
-    for f in reversed(filestack or []):
+    msg = 'in file:' if ctx.macrostack else 'when processing file:'
+    for f in reversed(ctx.filestack or []):
         if f is None:
             f = 'string'
         print(msg, f, file=sys.stderr)
@@ -1090,8 +1635,13 @@ def print_location():
 
 def process_file(input_file_name, **kwargs):
     """main processing pipeline"""
-    # initialize file stack for error-reporting
-    init_stacks(input_file_name)
+    # start processing in a new context, initializing file stack for error-reporting
+    ctx = XacroContext(input_file_name, verbosity=kwargs.get('verbosity', 1))
+    ctx.cache_dir = kwargs.get('cache_dir')
+    if kwargs.get('provenance'):
+        from .incremental import Provenance
+        ctx.provenance = Provenance()
+    set_current_context(ctx)
     # parse the document into a xml.dom tree
     doc = parse(None, input_file_name)
     # perform macro replacement
@@ -1107,23 +1657,107 @@ def process_file(input_file_name, **kwargs):
     for comment in banner:
         doc.insertBefore(comment, first)
 
+    if ctx.provenance is not None:
+        ctx.provenance.finish(doc, ctx)
+    for source in ctx.index_sources:
+        source.write_indexes(ctx.cache_dir)
     return doc
 
 
-_global_symbols = create_global_symbols()
+def scan_file(input_file_name, **kwargs):
+    """
+    Determine the files read when processing input_file_name within a new context,
+    evaluating only what is needed for that (see scan_deps()).
+    Return False if full processing is required to determine them.
+    """
+    set_current_context(XacroContext(input_file_name, verbosity=kwargs.get('verbosity', 1)))
+    try:
+        process_doc(parse(None, input_file_name), evaluate=scan_deps, **kwargs)
+    except Exception:  # including FullEvaluationRequired; errors are reported by full processing
+        return False
+    return True
+
+
+_global_symbols = None
+_global_symbols_lock = threading.Lock()
 
 
-def _process(input_file_name, opts):
-    try:
-        # open and process file
-        doc = process_file(input_file_name, **opts)
-        # open the output file
-        out = open_output(opts['output'])
+def global_symbols():
+    """Return the global symbols dictionary, creating it on first use"""
+    global _global_symbols
+    if _global_symbols is None:
+        with _global_symbols_lock:
+            if _global_symbols is None:
+                _global_symbols = create_global_symbols()
+    return _global_symbols
 
-    # error handling
-    except xml.parsers.expat.ExpatError as e:
+
+def generate(input_file_name, writer=None, just_deps=False, mappings=None, verbosity=1, cache_dir=None,
+             depfile=None, output=None, **kwargs):
+    """
+    Process input_file_name and return the result (XML or list of dependencies) as a string.
+    If writer (any object providing write()) is given, the result is streamed to writer instead.
+    Other than _process(), errors are raised as exceptions and sys.stdout is never touched.
+    :param cache_dir: reuse output cached in cache_dir if none of its inputs changed,
+                      store the indexes of lazily loaded yaml/json files there
+    :param depfile: write a Makefile depfile, listing all files read, for target output
+    """
+    if depfile and not output:
+        raise XacroException("writing a depfile requires an output file")
+    cache = None
+    if cache_dir:
+        from .cache import OutputCache
+        cache = OutputCache(cache_dir)
+    result = None
+    if cache:
+        key = cache.key(input_file_name, mappings, just_deps)
+        cached = cache.lookup(key)
+        if cached is not None:
+            result, entry = cached
+            # provide the files read and the values consulted via a new context, as if the input was processed
+            ctx = set_current_context(XacroContext(input_file_name, verbosity=verbosity))
+            ctx.all_includes = entry['order'][1:]
+            ctx.include_graph = entry['graph']
+            ctx.substitution_args['consulted'] = dict(((kind, name), value)
+                                                      for kind, name, value in entry['consulted'])
+            for msg in entry['warnings']:
+                warning(msg)
+
+    if result is None:
+        # process file (with a copy of mappings, which is extended by xacro:arg defaults)
+        # dependencies can often be determined without full processing
+        if not just_deps or not scan_file(input_file_name, mappings=dict(mappings) if mappings else None,
+                                          verbosity=verbosity):
+            doc = process_file(input_file_name, mappings=dict(mappings) if mappings else None,
+                               verbosity=verbosity, provenance=kwargs.get('provenance', False),
+                               cache_dir=cache_dir)
+        ctx = current_context()
+        if just_deps:  # only output list of dependencies
+            result = ' '.join(set(ctx.all_includes))
+        elif writer is not None and cache is None:  # stream XML output
+            xmlutils.backend.write_pretty_xml(doc, writer)
+        else:  # serialize XML output
+            result = xmlutils.backend.pretty_xml(doc)
+
+        if cache:
+            try:
+                cache.store(key, result, [input_file_name] + ctx.all_includes, ctx.substitution_args['consulted'],
+                            ctx.warnings, ctx.include_graph)
+            except (IOError, OSError) as e:
+                warning("failed to write cache: %s" % e)
+
+    if depfile:
+        write_depfile(depfile, [output], [input_file_name] + current_context().all_includes)
+    if writer is None or result is None:
+        return result
+    writer.write(result)
+
+
+def _report_error(e):
+    """Report exception e (raised while handling it) like the command line does and exit"""
+    if isinstance(e, xml.parsers.expat.ExpatError):
         error("XML parsing error: %s" % str(e), alt_text=None)
-        if verbosity > 0:
+        if current_context().verbosity > 0:
             print_location()
             print(file=sys.stderr)  # add empty separator line before error
             print("Check that:", file=sys.stderr)
@@ -1132,40 +1766,180 @@ def _process(input_file_name, opts):
                   "xmlns:xacro=\"http://www.ros.org/wiki/xacro\"", file=sys.stderr)
         sys.exit(2)  # indicate failure, but don't print stack trace on XML errors
 
+    msg = str(e)
+    if not msg:
+        msg = repr(e)
+    error(msg)
+    verbosity = current_context().verbosity
+    if verbosity > 0:
+        print_location()
+    if verbosity > 1:
+        print(file=sys.stderr)  # add empty separator line before error
+        raise  # create stack trace
+    else:
+        sys.exit(2)  # gracefully exit with error condition
+
+
+class _OutputWriter(object):
+    """Writer opening the output file (see open_output()) on first write, i.e. once processing succeeded"""
+
+    def __init__(self, output_filename):
+        self.output_filename = output_filename
+        self.out = None
+
+    def write(self, data):
+        if self.out is None:
+            self.out = open_output(self.output_filename)
+        self.out.write(data)
+
+    def close(self):
+        # only close output file, but not stdout
+        if self.output_filename and self.out is not None:
+            self.out.close()
+
+
+def _process(input_file_name, opts):
+    out = _OutputWriter(opts['output'])
+    try:
+        # process file, streaming the result in chunks to the output file
+        generate(input_file_name, writer=out, **opts)
     except Exception as e:
-        msg = str(e)
-        if not msg:
-            msg = repr(e)
-        error(msg)
-        if verbosity > 0:
-            print_location()
-        if verbosity > 1:
-            print(file=sys.stderr)  # add empty separator line before error
-            raise  # create stack trace
-        else:
-            sys.exit(2)  # gracefully exit with error condition
+        _report_error(e)
+    finally:
+        out.close()
+
+
+def process(input_file_name, just_deps=False, xacro_ns=True, verbosity=1, mappings={}, cache_dir=None):
+    """
+    Function to be used from python code, returning the processed XML.
+    Like the command line, errors are printed and exit with status 2. Use generate() to handle exceptions instead.
+    """
+    try:
+        return generate(input_file_name, just_deps=just_deps, verbosity=verbosity, mappings=mappings,
+                        cache_dir=cache_dir)
+    except Exception as e:
+        _report_error(e)
 
-    if opts['just_deps']:  # only output list of dependencies
-        out.write(' '.join(set(all_includes)))
-    else:  # write XML output
-        out.write(doc.toprettyxml(indent='  '))
 
-    # only close output file, but not stdout
-    if opts['output']:
+def map_jobs(func, jobs, max_workers=1):
+    """
+    Return [func(job) for job in jobs], distributing jobs over max_workers worker processes.
+    max_workers=None uses all CPUs. Where available, workers are forked and thus inherit
+    the already imported xacro module including its caches.
+    """
+    jobs = list(jobs)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+    if max_workers <= 1:
+        return [func(job) for job in jobs]
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    chunksize = max(1, len(jobs) // (4 * max_workers))  # amortize IPC, but keep workers balanced
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context(method)) as executor:
+        return list(executor.map(func, jobs, chunksize=chunksize))
+
+
+def _generate_file(job):
+    input_file_name, output, opts = job
+    try:
+        result = generate(input_file_name, **opts)
+        out = open_output(output)
+    except Exception as e:
+        return str(e) or repr(e)
+    out.write(result)
+    if output:
         out.close()
 
 
-def process(input_file_name, just_deps=False, xacro_ns=True, verbosity=1, mappings={}):
-    """Function to be used from python code, returning the processed XML"""
-    from io import StringIO
-    old, sys.stdout = sys.stdout, StringIO()  # temporarily replace sys.stdout with StringIO()
-    _process(input_file_name, dict(output=None, just_deps=just_deps, xacro_ns=xacro_ns, verbosity=verbosity, mappings=mappings))
-    sys.stdout.seek(0)
-    result = sys.stdout.read()
-    sys.stdout = old  # restore sys.stdout
-    return result
+def generate_files(jobs, max_workers=1, **opts):
+    """
+    Process (input, output) jobs, writing each result to its output file, optionally in parallel.
+    Accepts the same options as generate(). Returns a list holding the error message
+    of each failed job and None for successful ones.
+    """
+    return map_jobs(_generate_file, [(input, output, opts) for input, output in jobs], max_workers)
+
+
+def _process_job(job):
+    """Run _process() on a job, returning the list of files read (None on failure)"""
+    input_file_name, output, opts = job
+    try:
+        _process(input_file_name, dict(opts, output=output, depfile=None))
+        return [input_file_name] + current_context().all_includes
+    except SystemExit:  # error was reported by _process()
+        return None
+    except Exception:  # re-raised by _process() with verbosity > 1: show the stack trace, but continue
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def _process_batch(jobs, opts):
+    """
+    Process all (input, output) jobs within this process (or a pool of max_workers processes),
+    sharing parse and expression caches. Failing jobs are reported, but don't stop processing
+    of the remaining ones.
+    """
+    opts = dict((k, v) for k, v in opts.items() if k != 'jobs')
+    results = map_jobs(_process_job, [(input, output, opts) for input, output in jobs],
+                       opts.get('max_workers', 1))
+    if opts.get('depfile'):  # single depfile for all outputs
+        try:
+            write_depfile(opts['depfile'], [output for _, output in jobs],
+                          [f for deps in results if deps for f in deps])
+        except XacroException as e:
+            error(e)
+            sys.exit(2)
+    failed = results.count(None)
+    if failed:
+        error("%d of %d files failed to process" % (failed, len(jobs)), alt_text=None)
+        sys.exit(2)
 
 
 def main():
+    from .cli import process_args
     opts, input_file_name = process_args(sys.argv[1:])
-    _process(input_file_name, vars(opts))
+    if opts.serve:
+        from .server import serve
+        serve(opts.socket)
+    elif opts.watch:
+        from .watch import watch
+        watch(input_file_name, vars(opts))
+    elif opts.socket and opts.jobs is None:
+        from .server import run_client
+        code = run_client(opts.socket, input_file_name, vars(opts))
+        if code is None:  # no server running: fallback to in-process execution
+            _process(input_file_name, vars(opts))
+        elif code:
+            sys.exit(code)
+    elif opts.jobs is not None:
+        _process_batch(opts.jobs, vars(opts))
+    else:
+        _process(input_file_name, vars(opts))
+
+
+def __getattr__(name):
+    # submodules not needed for processing itself are only imported on first access
+    if name in ('cache', 'cli', 'incremental', 'server', 'substitution_args', 'watch'):
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+class _XacroModule(types.ModuleType):
+    """Module type forwarding the former module-level processing state to the current context"""
+
+    substitution_args_context = property(lambda self: current_context().substitution_args)
+
+
+def _forward_to_context(name):
+    return property(lambda self: getattr(current_context(), name),
+                    lambda self, value: setattr(current_context(), name, value))
+
+
+for _name in ['filestack', 'macrostack', 'all_includes', 'verbosity']:
+    setattr(_XacroModule, _name, _forward_to_context(_name))
+del _name
+sys.modules[__name__].__class__ = _XacroModule
@@ -0,0 +1,158 @@
+# Copyright (c) 2015, Open Source Robotics Foundation, Inc.
+# Copyright (c) 2013, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Open Source Robotics Foundation, Inc.
+#       nor the names of its contributors may be used to endorse or promote
+#       products derived from this software without specific prior
+#       written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Content-addressed cache of xacro's processing results.
+
+Entries are looked up by a key computed from the input filename and the processing options.
+Each entry records the hashes of all files read (input, includes, yaml files) as well as all
+external values consulted during processing (environment variables, package locations,
+glob results, cwd). A cached result is only returned if all of them are still unchanged.
+"""
+
+import functools
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+# bump to invalidate all existing cache entries
+CACHE_FORMAT = 3
+
+
+def file_hash(filename):
+    """Return the sha256 hash of a file's content, None if the file cannot be read"""
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def consulted_value(kind, name):
+    """Determine the current value of an external value consulted during processing"""
+    if kind == 'env':
+        return os.environ.get(name)
+    elif kind == 'find':
+        try:
+            from .substitution_args import _eval_find
+            return _eval_find(name)
+        except Exception:
+            return None
+    elif kind == 'glob':
+        return sorted(glob.glob(name))
+    elif kind == 'cwd':
+        return os.getcwd()
+    raise ValueError("unknown kind of consulted value: %s" % kind)
+
+
+@functools.lru_cache(maxsize=None)
+def package_hash():
+    """Return a hash of xacro's version and the sources of all its modules"""
+    try:
+        from importlib.metadata import version
+        data = [version('xacro')]
+    except Exception:  # not installed as a distribution
+        data = [None]
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(package_dir)):
+        if name.endswith('.py'):
+            data.append([name, file_hash(os.path.join(package_dir, name))])
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+class OutputCache(object):
+    """Cache of processed output in directory cache_dir"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(input_file_name, mappings, just_deps):
+        """Compute lookup key from input filename and processing options"""
+        data = json.dumps([CACHE_FORMAT, package_hash(),
+                           os.path.abspath(input_file_name), input_file_name,
+                           sorted((mappings or {}).items()), bool(just_deps)])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def lookup(self, key):
+        """
+        Return (output, entry) cached for key if it is still valid, None otherwise.
+        entry['order'] lists the files read, entry['graph'] is the include graph (see XacroContext),
+        entry['consulted'] lists [kind, name, value] of the consulted external values,
+        and entry['warnings'] the warnings emitted during processing.
+        """
+        try:
+            with open(self._path(key, '.json')) as f:
+                manifest = json.load(f)
+            for filename, digest in manifest['files'].items():
+                if file_hash(filename) != digest:
+                    return None
+            for kind, name, value in manifest['consulted']:
+                if consulted_value(kind, name) != value:
+                    return None
+            with open(self._path(key, '.out'), encoding='utf-8') as f:
+                return f.read(), manifest
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, key, output, files, consulted, warnings=(), include_graph=None):
+        """
+        Store output for key
+        :param files: list of all files read during processing
+        :param consulted: dict (kind, name) -> value of all external values consulted during processing
+        :param warnings: list of warnings emitted during processing, to be re-emitted on cache hits
+        :param include_graph: dict file -> list of files read by it
+        """
+        manifest = dict(files=dict((os.path.abspath(f), file_hash(os.path.abspath(f))) for f in files),
+                        order=list(files),
+                        consulted=[[kind, name, value] for (kind, name), value in consulted.items()],
+                        warnings=list(warnings),
+                        graph=include_graph or {})
+        # write output first: the manifest validates it
+        self._write(self._path(key, '.out'), output)
+        self._write(self._path(key, '.json'), json.dumps(manifest, indent=1))
+
+    @staticmethod
+    def _write(filename, content):
+        """Atomically write content to filename"""
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp, filename)
+        except Exception:
+            os.remove(tmp)
+            raise
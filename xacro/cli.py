@@ -30,6 +30,7 @@
 # Authors: Stuart Glaser, William Woodall, Robert Haschke
 # Maintainer: Morgan Quigley <morgan@osrfoundation.org>
 
+import os
 import textwrap
 from optparse import OptionParser, IndentedHelpFormatter
 from .color import colorize, warning, message
@@ -92,13 +93,57 @@ def load_mappings(argv):
     return mappings
 
 
+def output_filename(input_file_name, output_dir):
+    """Determine output file in output_dir for input_file_name, removing the suffix .xacro"""
+    base = os.path.basename(input_file_name)
+    if base.endswith('.xacro'):
+        base = base[:-len('.xacro')]
+    return os.path.join(output_dir, base)
+
+
+def load_manifest(filename):
+    """
+    Load (input, output) pairs from a manifest file, listing one input file per line,
+    optionally followed by a tab and its output file. Empty lines and lines starting with # are ignored.
+    Relative filenames are interpreted relative to the current working directory.
+    """
+    jobs = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) > 2 or not all(fields):
+                raise ValueError("invalid manifest line: %s" % line)
+            jobs.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return jobs
+
+
 def process_args(argv, require_input=True):
-    parser = ColoredOptionParser(usage="usage: %prog [options] <input>",
+    parser = ColoredOptionParser(usage="usage: %prog [options] <input> [<input> ...]",
                                  formatter=IndentedHelpFormatterWithNL())
     parser.add_option("-o", dest="output", metavar="FILE",
-                      help="write output to FILE instead of stdout")
+                      help="write output to FILE instead of stdout\n"
+                           "(an output directory when processing multiple inputs)")
+    parser.add_option("--manifest", dest="manifest", metavar="FILE",
+                      help="process all inputs listed in FILE (one per line, optionally followed by a tab and its output)")
+    parser.add_option("-j", "--jobs", dest="max_workers", metavar="N", type='int',
+                      help="process multiple inputs with N parallel processes (0: number of CPUs)")
     parser.add_option("--deps", action="store_true", dest="just_deps",
                       help="print file dependencies")
+    parser.add_option("--depfile", dest="depfile", metavar="FILE",
+                      help="write a Makefile/Ninja depfile to FILE, listing all files read")
+    parser.add_option("--cache-dir", dest="cache_dir", metavar="DIR",
+                      help="reuse output cached in DIR if none of its inputs changed "
+                           "and store indexes of lazily loaded yaml/json files there")
+    parser.add_option("--watch", action="store_true", dest="watch",
+                      help="watch all dependencies and regenerate output whenever one of them changes")
+    parser.add_option("--serve", action="store_true", dest="serve",
+                      help="run as server, processing requests of clients connecting to the socket")
+    parser.add_option("--socket", dest="socket", metavar="PATH",
+                      help="socket of the xacro server (default: $XACRO_SOCKET), required by --serve\n"
+                           "If given, processing is forwarded to the server (if running).")
     parser.add_option("--inorder", "-i", action="store_true", dest="in_order",
                       help="processing in read order (default, can be omitted)")
 
@@ -125,12 +170,47 @@ def process_args(argv, require_input=True):
         mappings = {}
         filtered_args = argv
 
-    parser.set_defaults(just_deps=False, verbosity=1)
+    parser.set_defaults(just_deps=False, verbosity=1, cache_dir=None, depfile=None, manifest=None,
+                        max_workers=1, serve=False, watch=False)
     (options, pos_args) = parser.parse_args(filtered_args)
+    if options.max_workers < 0:
+        parser.error("number of jobs must not be negative")
+    elif options.max_workers == 0:
+        options.max_workers = None  # all CPUs
     if options.in_order:
         message("xacro: in-order processing became default in ROS Melodic. You can drop the option.")
     options.in_order = True
 
+    if options.socket is None:
+        options.socket = os.environ.get('XACRO_SOCKET')
+    if options.serve:
+        if not options.socket:
+            parser.error("--serve requires a socket (--socket or $XACRO_SOCKET)")
+        pos_args = [None]
+
+    # batch mode: collect (input, output) jobs
+    options.jobs = None
+    if options.manifest or len(pos_args) > 1:
+        try:
+            jobs = load_manifest(options.manifest) if options.manifest else []
+        except (IOError, OSError, ValueError) as e:
+            parser.error("failed to load manifest: %s" % e)
+        jobs.extend((input, None) for input in pos_args)
+        if any(output is None for _, output in jobs):
+            if options.output is None:
+                parser.error("multiple inputs require an output directory (-o)")
+            jobs = [(input, output or output_filename(input, options.output)) for input, output in jobs]
+        outputs = [output for _, output in jobs]
+        if len(set(outputs)) != len(outputs):
+            parser.error("multiple inputs map to the same output file")
+        options.jobs = jobs
+        pos_args = [None]
+        if options.watch:
+            parser.error("--watch supports a single input file only")
+
+    if options.depfile and options.jobs is None and options.output is None:
+        parser.error("--depfile requires an output file (-o)")
+
     if len(pos_args) != 1:
         if require_input:
             parser.error("expected exactly one input file as argument")
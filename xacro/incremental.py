@@ -0,0 +1,262 @@
+# Copyright (c) 2015, Open Source Robotics Foundation, Inc.
+# Copyright (c) 2013, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Open Source Robotics Foundation, Inc.
+#       nor the names of its contributors may be used to endorse or promote
+#       products derived from this software without specific prior
+#       written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Fine-grained incremental re-expansion.
+
+While processing a document, Provenance records for each top-level macro call (i.e. a call from
+within the main file, outside of any macro) the macros it invoked (transitively), the files it read,
+and the output nodes it produced. If an included file changes, update() re-expands only the calls
+affected by that change and splices their new output into the previous document.
+
+This is only done if it is known to be safe, i.e. if the changed file only modifies the bodies of
+macros defined in it and these macros are only invoked by recorded side-effect free calls.
+Otherwise, update() declines and the document needs to be processed from scratch.
+"""
+
+from . import xmlutils
+
+
+class Call(object):
+    """Record of a top-level macro call and the output it produced"""
+
+    def __init__(self, node, macros, symbols, args, filestack):
+        self.node = xmlutils.backend.clone_node(node, deep=True)  # unevaluated call
+        self.macros_table = macros
+        self.symbols_table = symbols
+        # snapshot of the symbol table at the time of the call
+        self.symbols = dict(symbols)
+        self.unevaluated = set(symbols.unevaluated)
+        self.args = args
+        self.num_args = len(args)
+        self.filestack = list(filestack)
+        self.macros = set()  # all macros invoked
+        self.files = set()  # all files read
+        self.nodes = []  # produced output nodes
+        self.valid = True  # False if the call cannot be re-expanded in isolation
+
+    def has_side_effects(self):
+        """Check whether the call modified the global symbol table or args"""
+        if len(self.args) != self.num_args or \
+                set(self.symbols_table).symmetric_difference(self.symbols) - {'__builtins__'}:
+            return True
+        for key, value in self.symbols.items():
+            if key == '__builtins__':  # (re)set by safe_eval()
+                continue
+            # lazily evaluated properties are allowed to be resolved
+            if dict.__getitem__(self.symbols_table, key) is not value and key not in self.unevaluated:
+                return True
+        return False
+
+
+class Provenance(object):
+    """Provenance of a processed document: records top-level macro calls and the files read"""
+
+    def __init__(self):
+        self.doc = None
+        self.calls = []
+        self.active = None  # currently recorded call
+        self.replaced = None  # call being re-expanded by update()
+        self.unrecorded_macros = set()  # macros invoked outside of recorded calls
+        self.unrecorded_files = set()  # files read outside of recorded calls
+
+    def begin_call(self, node, macros, symbols, macro, ctx, toplevel):
+        """Start recording a macro call if it is a top-level one. Return the Call record or None"""
+        if self.active is not None:
+            self.active.macros.add(macro)
+            return None
+        if not toplevel or node.parentNode is None:
+            self.unrecorded_macros.add(macro)
+            return None
+
+        call = Call(node, macros, symbols, ctx.substitution_args['arg'], ctx.filestack)
+        call.macros.add(macro)
+        if self.replaced is not None:
+            self.calls[self.calls.index(self.replaced)] = call
+        else:
+            self.calls.append(call)
+        self.active = call
+        return call
+
+    def end_call(self, call, nodes, ctx):
+        """Finish recording call, which produced nodes"""
+        self.active = None
+        call.nodes = [n for n in nodes if n is not ctx.empty_text_node]
+        call.valid = bool(call.nodes) and not call.has_side_effects() and \
+            all(_defining_file(m) for m in call.macros)
+
+    def add_file(self, filename):
+        if self.active is not None:
+            self.active.files.add(filename)
+        else:
+            self.unrecorded_files.add(filename)
+
+    def finish(self, doc, ctx):
+        """Finish recording of doc, validating that each call's output is still in place"""
+        self.doc = doc
+        for call in self.calls:
+            if not call.valid:
+                continue
+            node = call.nodes[0]
+            parent = node.parentNode
+            for expected in call.nodes:
+                while node is ctx.empty_text_node:
+                    node = node.nextSibling
+                if node is not expected or parent is None:
+                    call.valid = False
+                    break
+                node = node.nextSibling
+
+
+def _defining_file(macro):
+    """Return the file defining macro, None if it was (re)defined in several files"""
+    files = set(history[-1] for history in macro.history)
+    return files.pop() if len(files) == 1 else None
+
+
+def _macro_elements(root):
+    """Return dict name -> xacro:macro element of all macro definitions in root, None on duplicates"""
+    result = {}
+    for elt in root.getElementsByTagName('xacro:macro'):
+        name = elt.getAttribute('name')
+        if name in result:
+            return None
+        result[name] = elt
+    return result
+
+
+def _interface(root):
+    """Serialize root with all macro bodies stripped"""
+    root = xmlutils.backend.clone_node(root, deep=True)
+    for elt in root.getElementsByTagName('xacro:macro'):
+        del elt.childNodes[:]
+    return root.toxml()
+
+
+def _changed_macros(filename, macros):
+    """
+    Return dict Macro -> new xacro:macro element of all macros defined in filename whose bodies changed.
+    Return None if filename changed anything beyond macro bodies.
+    """
+    from . import include_cache
+
+    old_root = include_cache.cached_root(filename)
+    if old_root is None:
+        return None
+    try:
+        new_root = include_cache.parse(filename)
+    except Exception:
+        return None
+    old_elts, new_elts = _macro_elements(old_root), _macro_elements(new_root)
+    if old_elts is None or new_elts is None or _interface(old_root) != _interface(new_root):
+        return None
+
+    changed = {}
+    for m in macros:
+        if filename not in (history[-1] for history in m.history):
+            continue
+        name = m.body.getAttribute('name')
+        if name not in old_elts or _defining_file(m) is None:
+            return None
+        if old_elts[name].toxml() != new_elts[name].toxml():
+            changed[m] = new_elts[name]
+    return changed
+
+
+def update(ctx, changed_files):
+    """
+    Update the document processed within context ctx for changed_files, re-expanding affected calls only.
+    Return the updated document, None if the document needs to be processed from scratch.
+    """
+    from . import MacroBody, Table, handle_macro_call, set_current_context
+
+    prov = ctx.provenance
+    if prov is None or prov.doc is None:
+        return None
+    set_current_context(ctx)
+
+    known_macros = set(prov.unrecorded_macros)
+    for call in prov.calls:
+        known_macros.update(call.macros)
+
+    affected = set()
+    changed_macros = {}
+    for filename in changed_files:
+        calls = [call for call in prov.calls if filename in call.files]
+        if filename in prov.unrecorded_files:
+            changed = _changed_macros(filename, known_macros)
+            if changed is None:
+                return None
+            changed_macros.update(changed)
+        elif not calls:
+            return None  # unknown file, e.g. the main file
+        affected.update(calls)
+
+    if any(m in prov.unrecorded_macros for m in changed_macros):
+        return None
+    affected.update(call for call in prov.calls if call.macros.intersection(changed_macros))
+    if not all(call.valid for call in affected):
+        return None
+
+    # update macro definitions
+    for m, elt in changed_macros.items():
+        if elt.parentNode is not None:
+            elt.parentNode.removeChild(elt)
+        m.body = elt
+        m.ir = MacroBody(elt)
+
+    # re-expand affected calls in document order
+    old_marker, old_args = ctx.empty_text_node, ctx.substitution_args['arg']
+    try:
+        for call in [c for c in prov.calls if c in affected]:
+            ctx.filestack = list(call.filestack)
+            ctx.macrostack = []
+            ctx.empty_text_node = prov.doc.createTextNode('\n\n')  # don't move the marker within the document
+            ctx.substitution_args['arg'] = call.args
+
+            symbols = Table(call.symbols_table.parent)
+            dict.update(symbols, call.symbols)
+            symbols.unevaluated = set(call.unevaluated)
+
+            # replace the call's previous output by the (unevaluated) call
+            node = xmlutils.backend.clone_node(call.node, deep=True)
+            parent = call.nodes[0].parentNode
+            parent.insertBefore(node, call.nodes[0])
+            for n in call.nodes:
+                parent.removeChild(n)
+
+            prov.replaced = call
+            handle_macro_call(node, call.macros_table, symbols)
+            prov.replaced = None
+    finally:
+        ctx.empty_text_node, ctx.substitution_args['arg'] = old_marker, old_args
+        prov.replaced = prov.active = None
+
+    prov.finish(prov.doc, ctx)
+    return prov.doc
@@ -0,0 +1,373 @@
+# Copyright (c) 2015, Open Source Robotics Foundation, Inc.
+# Copyright (c) 2013, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Open Source Robotics Foundation, Inc.
+#       nor the names of its contributors may be used to endorse or promote
+#       products derived from this software without specific prior
+#       written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Indexed loading of large JSON and YAML parameter files.
+
+Instead of constructing the whole document, only the positions of the values of the top-level mapping
+are determined. Values are read from file and loaded once they are accessed. Large nested mappings
+are indexed in turn, such that lookups via dotted access only load the referenced subtrees.
+If a cache directory is given (--cache-dir), the indexes are stored in its subdirectory index
+and reused while the file is unchanged.
+"""
+
+import codecs
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections.abc import Mapping
+
+from . import XacroException, YamlListWrapper
+
+# mappings larger than this (in bytes) are indexed instead of being loaded completely
+INDEX_THRESHOLD = 1 << 16
+
+
+class NotIndexable(Exception):
+    """Raised if a document cannot be indexed, e.g. because it uses yaml aliases"""
+    pass
+
+
+class IndexedDict(Mapping):
+    """Read-only mapping of an indexed mapping in source, providing dotted access like YamlDictWrapper"""
+
+    def __init__(self, source, start, end, index=None):
+        self._source = source
+        self._start = start
+        self._end = end
+        self._index = index  # key -> (start, end) of its value, created on first access
+
+    def _spans(self):
+        if self._index is None:
+            self._index = self._source.index(self._start, self._end)
+        return self._index
+
+    def __getitem__(self, item):
+        try:
+            start, end = self._spans()[item]
+        except KeyError:
+            raise XacroException("No such key: '{}'".format(item))
+        return self._source.value(start, end)
+
+    def __getattr__(self, item):
+        # only called for attributes not found otherwise: not for keys shadowing our own attributes
+        if item.startswith('__') or item in ('_source', '_start', '_end', '_index'):
+            raise AttributeError(item)
+        return self[item]
+
+    def __contains__(self, key):
+        return key in self._spans()
+
+    def __iter__(self):
+        return iter(self._spans())
+
+    def __len__(self):
+        return len(self._spans())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+# bump to invalidate all stored indexes
+INDEX_FORMAT = 2
+
+
+def index_filename(cache_dir, filename):
+    """Return the file in cache_dir storing the indexes of filename"""
+    key = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'index', key + '.json')
+
+
+class _Text(object):
+    """Text decoded from the bytes read at offset base (and prefixed), mapping character positions to byte offsets"""
+
+    def __init__(self, data, base, prefix=''):
+        self.text = prefix + data.decode('utf-8')
+        self.base = base
+        self.skip = len(prefix)
+        self.ascii = len(self.text) == self.skip + len(data)
+        self._pos, self._offset = self.skip, 0
+
+    def offset(self, pos):
+        """Return the byte offset of character position pos (looking up increasing positions is fastest)"""
+        if self.ascii:
+            return self.base + pos - self.skip
+        if pos < self._pos:
+            self._pos, self._offset = self.skip, 0
+        self._offset += len(self.text[self._pos:pos].encode('utf-8'))
+        self._pos = pos
+        return self.base + self._offset
+
+
+class Source(object):
+    """
+    Document of the (utf-8 encoded) file f, which is read on demand, keeping track of the indexes
+    of its mappings. Positions are byte offsets into the file. Subclasses implement scan(start, end)
+    to index the mapping at [start, end) and load(start, end) to load the value at [start, end).
+    """
+    kind = None
+
+    def __init__(self, f):
+        st = os.fstat(f.fileno())
+        self.filename = os.path.abspath(f.name)
+        self.stamp = [st.st_size, st.st_mtime_ns]
+        self.start = len(codecs.BOM_UTF8) if self.read(0, len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 0
+        self.end = st.st_size
+        self.indexes = {}  # (start, end) -> key -> (start, end), None if not indexable
+        self.values = {}  # (start, end) -> loaded (read-only) value
+        self._read_dirs = set()  # cache dirs whose indexes were read
+        self._stored_dirs = set()  # cache dirs storing the current indexes
+
+    def read(self, start, end):
+        """Return the bytes [start, end) of the file"""
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def index(self, start, end):
+        """Return key -> (start, end) for the values of the mapping at [start, end)"""
+        try:
+            index = self.indexes[(start, end)]
+        except KeyError:
+            try:
+                index = self.scan(start, end)
+            except NotIndexable:
+                index = None
+            self.indexes[(start, end)] = index
+            self._stored_dirs.clear()
+        if index is None:
+            raise NotIndexable()
+        return index
+
+    def value(self, start, end):
+        """Return the value at [start, end), loading it on first access"""
+        try:
+            return self.values[(start, end)]
+        except KeyError:
+            value = self.values[(start, end)] = self.load(start, end)
+            return value
+
+    def read_indexes(self, cache_dir):
+        """Add the indexes stored in cache_dir (once), if they match the file"""
+        if cache_dir in self._read_dirs:
+            return
+        self._read_dirs.add(cache_dir)
+        try:
+            with open(index_filename(cache_dir, self.filename)) as f:
+                data = json.load(f)
+            if data['format'] != INDEX_FORMAT or data['kind'] != self.kind or data['stamp'] != self.stamp:
+                return
+            indexes = {}
+            for start, end, index in data['indexes']:
+                indexes[(start, end)] = None if index is None else \
+                    dict((key, (value_start, value_end)) for key, value_start, value_end in index)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return
+        if not set(self.indexes).difference(indexes):
+            self._stored_dirs.add(cache_dir)
+        indexes.update(self.indexes)
+        self.indexes = indexes
+
+    def write_indexes(self, cache_dir):
+        """Store the indexes in cache_dir, unless they are stored there already"""
+        if cache_dir in self._stored_dirs:
+            return
+        indexes = []
+        for (start, end), index in self.indexes.items():
+            if index is not None:
+                if not all(key is None or isinstance(key, (str, int, float)) for key in index):
+                    continue  # key type cannot be stored
+                index = [[key, value_start, value_end] for key, (value_start, value_end) in index.items()]
+            indexes.append([start, end, index])
+        data = dict(format=INDEX_FORMAT, kind=self.kind, stamp=self.stamp, indexes=indexes)
+        filename = index_filename(cache_dir, self.filename)
+        try:  # atomically replace filename, failing silently: the index can be rebuilt anytime
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, filename)
+            except Exception:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError, ValueError):
+            return
+        self._stored_dirs.add(cache_dir)
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+def _skip(s, pos):
+    return _whitespace.match(s, pos).end()
+
+
+def _expect(s, pos, chars):
+    if s[pos:pos + 1] not in chars:
+        raise json.JSONDecodeError("Expecting one of '%s'" % chars, s, pos)
+
+
+class JsonSource(Source):
+    """JSON document"""
+    kind = 'json'
+
+    def scan(self, start, end):
+        text = _Text(self.read(start, end), start)
+        s = text.text
+        index = {}
+        pos = _skip(s, 0)
+        if s[pos:pos + 1] != '{':
+            raise NotIndexable('not an object')
+        pos = _skip(s, pos + 1)
+        if s[pos:pos + 1] == '}':
+            return index
+        while True:
+            _expect(s, pos, '"')
+            key, pos = _decoder.raw_decode(s, pos)
+            pos = _skip(s, pos)
+            _expect(s, pos, ':')
+            value_start = _skip(s, pos + 1)
+            _, pos = _decoder.raw_decode(s, value_start)
+            index[key] = (text.offset(value_start), text.offset(pos))
+            pos = _skip(s, pos)
+            _expect(s, pos, ',}')
+            if s[pos] == '}':
+                return index
+            pos = _skip(s, pos + 1)
+
+    def load(self, start, end):
+        if end - start > INDEX_THRESHOLD and self.read(start, start + 1) == b'{':
+            return IndexedDict(self, start, end)
+        return YamlListWrapper.wrap_tree(json.loads(self.read(start, end).decode('utf-8')))
+
+
+# plain scalars, which are certainly strings when used as mapping keys
+_plain_key = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+_special_keys = frozenset(['y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null'])
+
+
+class YamlSource(Source):
+    """YAML document, loaded with the given loader class"""
+    kind = 'yaml'
+
+    def __init__(self, f, loader):
+        self.loader = loader
+        super(YamlSource, self).__init__(f)
+
+    def _column(self, pos):
+        """Return the column (in characters) of byte offset pos"""
+        line_start, size = pos, 256
+        while line_start > self.start:
+            prefix = self.read(max(self.start, line_start - size), line_start)
+            newline = prefix.rfind(b'\n')
+            if newline >= 0:
+                line_start -= len(prefix) - newline - 1
+                break
+            line_start -= len(prefix)
+            size *= 2
+        return len(self.read(line_start, pos).decode('utf-8'))
+
+    def _snippet(self, start, end):
+        """Return the text at [start, end), indented such that it can be parsed on its own"""
+        return _Text(self.read(start, end), start, ' ' * self._column(start))
+
+    def _key(self, event, text):
+        if event.tag is None and event.style is None and _plain_key.match(event.value) and \
+           event.value.lower() not in _special_keys:
+            return event.value
+        import yaml
+        snippet = ' ' * event.start_mark.column + text.text[event.start_mark.index:event.end_mark.index]
+        return yaml.load(snippet, Loader=self.loader)
+
+    def scan(self, start, end):
+        import yaml
+        text = self._snippet(start, end)
+        index = {}
+        depth = 0
+        key = value_start = None
+        expect_key = True
+        for event in yaml.parse(text.text, Loader=self.loader):
+            if isinstance(event, yaml.AliasEvent) or getattr(event, 'anchor', None) is not None:
+                raise NotIndexable('yaml aliases cannot be indexed')
+            if isinstance(event, yaml.CollectionEndEvent):
+                depth -= 1
+                if depth == 1:
+                    index[key] = (value_start, text.offset(event.end_mark.index))
+                    expect_key = True
+                elif depth == 0:
+                    break
+                continue
+            if depth == 0 and isinstance(event, (yaml.ScalarEvent, yaml.SequenceStartEvent)):
+                raise NotIndexable('not a mapping')
+            if depth == 1:
+                if expect_key:
+                    if not isinstance(event, yaml.ScalarEvent):
+                        raise NotIndexable('complex mapping keys cannot be indexed')
+                    key = self._key(event, text)
+                    expect_key = False
+                    continue
+                value_start = text.offset(event.start_mark.index)
+                if isinstance(event, yaml.ScalarEvent):
+                    index[key] = (value_start, text.offset(event.end_mark.index))
+                    expect_key = True
+            if isinstance(event, yaml.CollectionStartEvent):
+                depth += 1
+        return index
+
+    def _is_mapping(self, start):
+        import yaml
+        # the first events only require parsing the beginning of the value
+        snippet = ' ' * self._column(start) + self.read(start, start + 4096).decode('utf-8', 'ignore')
+        try:
+            for event in yaml.parse(snippet, Loader=self.loader):
+                if not isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)):
+                    return isinstance(event, yaml.MappingStartEvent)
+        except yaml.YAMLError:  # let load() report errors
+            return False
+
+    def load(self, start, end):
+        import yaml
+        if end - start > INDEX_THRESHOLD and self._is_mapping(start):
+            return IndexedDict(self, start, end)
+        return YamlListWrapper.wrap_tree(yaml.load(self._snippet(start, end).text, Loader=self.loader))
+
+
+def load_indexed(source):
+    """Return the document of source (a JsonSource or YamlSource) with an indexed top-level mapping"""
+    try:
+        return IndexedDict(source, source.start, source.end, source.index(source.start, source.end))
+    except NotIndexable:
+        return source.value(source.start, source.end)
@@ -0,0 +1,187 @@
+# Copyright (c) 2015, Open Source Robotics Foundation, Inc.
+# Copyright (c) 2013, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Open Source Robotics Foundation, Inc.
+#       nor the names of its contributors may be used to endorse or promote
+#       products derived from this software without specific prior
+#       written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Persistent xacro server, keeping its caches (parsed includes, compiled expressions, ...) warm
+across requests, and the corresponding thin client.
+
+The client sends a single JSON request (input file, options, cwd, and environment)
+over a Unix socket and receives the exit code, stdout, and stderr of processing.
+Requests are processed sequentially (see handle_request()), because they temporarily change
+the process-wide cwd, environment, stdout, and stderr.
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from .color import error, message
+
+
+def _connect(socket_path):
+    """Return a socket connected to socket_path, None if no server is listening there"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def _send(sock, obj):
+    sock.sendall(json.dumps(obj).encode('utf-8'))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def _receive(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+# serializes handle_request() calls, which modify process-wide state
+_request_lock = threading.Lock()
+
+
+def handle_request(request):
+    """Process a single request within the server process, returning the response"""
+    with _request_lock:
+        return _handle_request(request)
+
+
+def _handle_request(request):
+    from . import _process, current_context
+
+    old_cwd, old_environ = os.getcwd(), dict(os.environ)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    files = []
+    try:
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                # output and depfile are written by the client
+                _process(request['input'], dict(request['opts'], output=None, depfile=None))
+                files = [os.path.abspath(f) for f in [request['input']] + current_context().all_includes]
+                code = 0
+            except SystemExit as e:
+                code = e.code
+            except Exception:
+                traceback.print_exc()
+                code = 1
+    finally:
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_environ)
+    return dict(code=code, stdout=stdout.getvalue(), stderr=stderr.getvalue(), files=files)
+
+
+def serve(socket_path):
+    """Serve requests on socket_path until interrupted"""
+    if os.path.exists(socket_path):
+        sock = _connect(socket_path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError("xacro server already running on %s" % socket_path)
+        os.remove(socket_path)  # remove stale socket
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)  # only accessible by the current user
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # shutdown gracefully
+    message("xacro: serving on %s" % socket_path)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    response = handle_request(_receive(conn))
+                except (ValueError, KeyError, TypeError, OSError) as e:
+                    response = dict(code=2, stdout='', stderr='invalid request: %s\n' % e)
+                try:
+                    _send(conn, response)
+                except OSError:
+                    pass  # client is gone
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def run_client(socket_path, input_file_name, opts):
+    """
+    Let the server at socket_path process input_file_name, writing its output as _process() would.
+    Returns the exit code, None if no server is reachable (or the request is invalid).
+    """
+    from . import open_output, write_depfile, XacroException
+
+    if opts.get('depfile') and not opts.get('output'):
+        return None  # let in-process execution report the error
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    with sock:
+        try:
+            _send(sock, dict(input=input_file_name, opts=opts, cwd=os.getcwd(), env=dict(os.environ)))
+            response = _receive(sock)
+        except (OSError, ValueError):
+            return None
+
+    sys.stderr.write(response['stderr'])
+    if response['code'] == 0:
+        out = open_output(opts['output'])
+        out.write(response['stdout'])
+        if opts['output']:
+            out.close()
+        if opts.get('depfile'):
+            try:
+                write_depfile(opts['depfile'], [opts['output']], response['files'])
+            except XacroException as e:
+                error(e)
+                return 2
+    return response['code']
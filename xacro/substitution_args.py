@@ -37,12 +37,12 @@ This is currently used by roslaunch and xacro, but it is not yet a top-level ROS
 This file has been modified from ros_comm/tools/roslaunch/src/roslaunch/substitution_args.py
 """
 
+import functools
 import math
 import os
-import yaml
-
-from ament_index_python.packages import get_package_share_directory, PackageNotFoundError
-from io import StringIO
+import re
+import threading
+import types
 
 
 class SubstitutionException(Exception):
@@ -55,6 +55,16 @@ class ArgException(SubstitutionException):
     pass
 
 
+def record_consulted(context, kind, name, value):
+    """
+    Record an external value (environment variable, package location, ...) consulted while
+    resolving substitution args in context['consulted'] (if present), keyed by (kind, name).
+    This allows to validate cached results later on (see xacro.cache).
+    """
+    if context is not None and context.get('consulted') is not None:
+        context['consulted'][(kind, name)] = value
+
+
 def _eval_env(name):
     """
     Returns the environment variable value or throws exception.
@@ -69,18 +79,20 @@ def _eval_env(name):
             'environment variable %s is not set' % str(e))
 
 
-def _env(resolved, a, args, context):
+def _env(a, args, context):
     """
     Process $(env) arg.
 
-    @return: updated resolved argument
+    @return: substituted value
     @rtype: str
     @raise SubstitutionException: if arg invalidly specified
     """
     if len(args) != 1:
         raise SubstitutionException(
             '$(env var) command only accepts one argument [%s]' % a)
-    return resolved.replace('$(%s)' % a, _eval_env(args[0]))
+    value = _eval_env(args[0])
+    record_consulted(context, 'env', args[0], value)
+    return value
 
 
 def _eval_optenv(name, default=''):
@@ -97,18 +109,19 @@ def _eval_optenv(name, default=''):
     return default
 
 
-def _optenv(resolved, a, args, context):
+def _optenv(a, args, context):
     """
     Process $(optenv) arg.
 
-    @return: updated resolved argument
+    @return: substituted value
     @rtype: str
     @raise SubstitutionException: if arg invalidly specified
     """
     if len(args) == 0:
         raise SubstitutionException(
             '$(optenv var) must specify an environment variable [%s]' % a)
-    return resolved.replace('$(%s)' % a, _eval_optenv(args[0], default=' '.join(args[1:])))
+    record_consulted(context, 'env', args[0], os.environ.get(args[0]))
+    return _eval_optenv(args[0], default=' '.join(args[1:]))
 
 
 def _eval_dirname(filename):
@@ -125,34 +138,66 @@ def _eval_dirname(filename):
     return os.path.abspath(os.path.dirname(filename))
 
 
-def _dirname(resolved, a, args, context):
+def _dirname(a, args, context):
     """
     Process $(dirname).
 
-    @return: updated resolved argument
+    @return: substituted value
     @rtype: str
     @raise SubstitutionException: if no information about the current launch file is available,
     for example if XML was passed via stdin, or this is a remote launch.
     """
-    return resolved.replace('$(%s)' % a, _eval_dirname(context.get('filename', None)))
+    return _eval_dirname(context.get('filename', None))
+
+
+class PackageIndex(object):
+    """
+    Process-wide index of package locations, built once from the ament index
+    and rebuilt whenever AMENT_PREFIX_PATH changes.
+    """
+
+    def __init__(self):
+        self.prefix_path = None
+        self.prefixes = None  # package name -> install prefix
+        self.lock = threading.Lock()
+
+    def share_directory(self, pkg):
+        from ament_index_python.packages import get_package_share_directory, get_packages_with_prefixes
+        prefix_path = os.environ.get('AMENT_PREFIX_PATH')
+        with self.lock:
+            if self.prefixes is None or prefix_path != self.prefix_path:
+                try:
+                    self.prefixes = get_packages_with_prefixes()
+                except EnvironmentError:
+                    self.prefixes = {}
+                self.prefix_path = prefix_path
+            prefix = self.prefixes.get(pkg)
+        if prefix is None:  # let ament_index_python handle (and report) unknown packages
+            return get_package_share_directory(pkg)
+        return os.path.join(prefix, 'share', pkg)
+
+
+package_index = PackageIndex()
 
 
 def _eval_find(pkg):
-    return get_package_share_directory(pkg)
+    return package_index.share_directory(pkg)
 
 
-def _find(resolved, a, args, context):
+def _find(a, args, context):
     """
     Process $(find PKG).
 
     Resolves to the share folder of the package
-    :returns: updated resolved argument, ``str``
+    :returns: substituted value, ``str``
     :raises: :exc:SubstitutionException: if PKG invalidly specified
     """
     if len(args) != 1:
         raise SubstitutionException(
             '$(find pkg) accepts exactly one argument [%s]' % a)
-    return resolved.replace('$(%s)' % a, _eval_find(args[0]))
+    value = _eval_find(args[0])
+    record_consulted(context, 'find', args[0], value)
+    return value
 
 
 def _eval_arg(name, args):
@@ -163,11 +208,11 @@ def _eval_arg(name, args):
         raise ArgException(name)
 
 
-def _arg(resolved, a, args, context):
+def _arg(a, args, context):
     """
     Process $(arg) arg.
 
-    :returns: updated resolved argument, ``str``
+    :returns: substituted value, ``str``
     :raises: :exc:`ArgException` If arg invalidly specified
     """
     if len(args) == 0:
@@ -179,7 +224,7 @@ def _arg(resolved, a, args, context):
 
     if 'arg' not in context:
         context['arg'] = {}
-    return resolved.replace('$(%s)' % a, _eval_arg(name=args[0], args=context['arg']))
+    return _eval_arg(name=args[0], args=context['arg'])
 
 
 # Create a dictionary of global symbols that will be available in the eval
@@ -196,6 +241,8 @@ _eval_dict = {
 }
 # also define all math symbols and functions
 _eval_dict.update(math.__dict__)
+# read-only view shared by all evaluations
+_eval_dict = types.MappingProxyType(_eval_dict)
 
 
 def convert_value(value, type_):
@@ -240,6 +287,7 @@ def convert_value(value, type_):
             return False
         raise ValueError("%s is not a '%s' type" % (value, type_))
     elif type_ == 'yaml':
+        import yaml
         try:
             return yaml.load(value)
         except yaml.parser.ParserError as e:
@@ -248,17 +296,62 @@ def convert_value(value, type_):
         raise ValueError("Unknown type '%s'" % type_)
 
 
+# functions available in $(eval ...) that depend on the substitution context
+def _eval_arg_context(context, name):
+    return convert_value(_eval_arg(name, args=context['arg']), 'auto')
+
+
+def _eval_dirname_context(context):
+    return _eval_dirname(context['filename'])
+
+
+# record consulted environment variables and packages
+def _eval_env_context(context, name):
+    value = _eval_env(name)
+    record_consulted(context, 'env', name, value)
+    return value
+
+
+def _eval_optenv_context(context, name, default=''):
+    record_consulted(context, 'env', name, os.environ.get(name))
+    return _eval_optenv(name, default)
+
+
+def _eval_find_context(context, pkg):
+    value = _eval_find(pkg)
+    record_consulted(context, 'find', pkg, value)
+    return value
+
+
+_eval_context_functions = types.MappingProxyType({
+    'arg': _eval_arg_context,
+    'dirname': _eval_dirname_context,
+    'env': _eval_env_context,
+    'optenv': _eval_optenv_context,
+    'find': _eval_find_context,
+})
+
+
 class _DictWrapper(object):
+    """Namespace of $(eval ...): context functions, then _eval_dict, then args"""
 
-    def __init__(self, args, functions):
-        self._args = args
-        self._functions = functions
+    def __init__(self, context):
+        self._context = context
 
     def __getitem__(self, key):
         try:
-            return self._functions[key]
+            return functools.partial(_eval_context_functions[key], self._context)
         except KeyError:
-            return convert_value(self._args[key], 'auto')
+            pass
+        try:
+            return _eval_dict[key]
+        except KeyError:
+            return convert_value(self._context['arg'][key], 'auto')
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_eval(s):
+    return compile(s, '<string>', 'eval')
 
 
 def _eval(s, context):
@@ -266,26 +359,12 @@ def _eval(s, context):
     if 'arg' not in context:
         context['arg'] = {}
 
-    # inject arg context
-    def _eval_arg_context(name):
-        return convert_value(_eval_arg(name, args=context['arg']), 'auto')
-
-    # inject dirname context
-    def _eval_dirname_context():
-        return _eval_dirname(context['filename'])
-
-    functions = {
-        'arg': _eval_arg_context,
-        'dirname': _eval_dirname_context
-    }
-    functions.update(_eval_dict)
-
     # ignore values containing double underscores (for safety)
     # http://nedbatchelder.com/blog/201206/eval_really_is_dangerous.html
     if s.find('__') >= 0:
         raise SubstitutionException(
             '$(eval ...) may not contain double underscore expressions')
-    return str(eval(s, {}, _DictWrapper(context['arg'], functions)))
+    return str(eval(_compile_eval(s), {}, _DictWrapper(context)))
 
 
 def resolve_args(arg_str, context=None, filename=None):
@@ -323,75 +402,62 @@ def resolve_args(arg_str, context=None, filename=None):
     return resolved
 
 
-def _resolve_args(arg_str, context, commands):
+_VALID_COMMANDS = ['find', 'env', 'optenv', 'dirname', 'arg']
 
-    valid = ['find', 'env', 'optenv', 'dirname', 'arg']
-    resolved = arg_str
-    for a in _collect_args(arg_str):
-        splits = [s for s in a.split(' ') if s]
-        if not splits[0] in valid:
+
+def _resolve_args(arg_str, context, commands):
+    parts = []
+    for segment in _parse_args(arg_str):
+        if isinstance(segment, str):  # literal text
+            parts.append(segment)
+            continue
+        a, command, args = segment
+        if command not in _VALID_COMMANDS:
             raise SubstitutionException('Unknown substitution command [%s]. '
-                                        'Valid commands are %s' % (a, valid))
-        command = splits[0]
-        args = splits[1:]
+                                        'Valid commands are %s' % (a, _VALID_COMMANDS))
         if command in commands:
-            resolved = commands[command](resolved, a, args, context)
-    return resolved
+            parts.append(commands[command](a, args, context))
+        else:
+            parts.append('$(%s)' % a)
+    return ''.join(parts)
 
 
-_OUT = 0
-_DOLLAR = 1
-_LP = 2
-_IN = 3
+# a substitution arg: $( followed by anything up to the closing parenthesis
+# or up to a (disallowed) nested dollar sign or left parenthesis
+_ARG_PATTERN = re.compile(r'\$\(([^$()]*)([$()]?)')
 
 
-def _collect_args(arg_str):
+@functools.lru_cache(maxsize=4096)
+def _parse_args(arg_str):
     """
-    State-machine parser for resolve_args.
+    Parse arg_str into a tuple of segments, either literal strings or substitution args.
 
     Substitution args are of the form:
     $(find package_name)/scripts/foo.py $(export some/attribute blar) non-relevant stuff
+    and are returned as tuples (arg, command, args), e.g. ('find package_name', 'find', ['package_name'])
 
     @param arg_str: argument string to parse args from
     @type  arg_str: str
     @raise SubstitutionException: if args are invalidly specified
-    @return: list of arguments
-    @rtype: [str]
+    @return: tuple of segments
     """
-    buff = StringIO()
-    args = []
-    state = _OUT
-    for c in arg_str:
-        # No escapes supported
-        if c == '$':
-            if state == _OUT:
-                state = _DOLLAR
-            elif state == _DOLLAR:
-                pass
-            else:
-                raise SubstitutionException('Dollar signs "$" cannot be '
-                                            'inside of substitution args [%s]' % arg_str)
-        elif c == '(':
-            if state == _DOLLAR:
-                state = _LP
-            elif state != _OUT:
-                raise SubstitutionException('Invalid left parenthesis "(" '
-                                            'in substitution args [%s]' % arg_str)
-        elif c == ')':
-            if state == _IN:
-                # save contents of collected buffer
-                args.append(buff.getvalue())
-                buff.truncate(0)
-                buff.seek(0)
-                state = _OUT
-            else:
-                state = _OUT
-        elif state == _DOLLAR:
-            # left paren must immediately follow dollar sign to enter _IN state
-            state = _OUT
-        elif state == _LP:
-            state = _IN
-
-        if state == _IN:
-            buff.write(c)
-    return args
+    segments = []
+    start = 0
+    for match in _ARG_PATTERN.finditer(arg_str):
+        a, end = match.groups()
+        if end == '$':
+            raise SubstitutionException('Dollar signs "$" cannot be '
+                                        'inside of substitution args [%s]' % arg_str)
+        elif end == '(':
+            raise SubstitutionException('Invalid left parenthesis "(" '
+                                        'in substitution args [%s]' % arg_str)
+        elif not end or not a:  # unterminated or empty substitution arg: keep as is
+            continue
+        splits = [s for s in a.split(' ') if s] or [None]
+        if match.start() > start:
+            segments.append(arg_str[start:match.start()])
+        segments.append((a, splits[0], tuple(splits[1:])))
+        start = match.end()
+    if start < len(arg_str):
+        segments.append(arg_str[start:])
+    return tuple(segments)
@@ -0,0 +1,138 @@
+# Copyright (c) 2015, Open Source Robotics Foundation, Inc.
+# Copyright (c) 2013, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Open Source Robotics Foundation, Inc.
+#       nor the names of its contributors may be used to endorse or promote
+#       products derived from this software without specific prior
+#       written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Watch mode: regenerate output whenever one of the input's dependencies changes.
+
+Files are polled for changes of their size or modification time. Only if their content
+actually changed, the output is regenerated. If possible, only the macro calls affected by the
+change are re-expanded (see incremental.py). Otherwise, the input is processed again, reusing
+parsed files from the include cache, such that only modified files need to be parsed again.
+"""
+
+import os
+import time
+import traceback
+
+from .cache import consulted_value, file_hash
+from .color import message
+from .incremental import update
+from . import xmlutils
+
+
+class Dependencies(object):
+    """Snapshot of all files read and glob patterns evaluated during processing"""
+
+    def __init__(self, files, include_graph, consulted):
+        self.include_graph = include_graph
+        self.files = dict((f, self._stat(f)) for f in set(files))
+        self.hashes = dict((f, file_hash(f)) for f in self.files)
+        self.globs = dict((name, value) for (kind, name), value in consulted.items() if kind == 'glob')
+
+    @staticmethod
+    def _stat(filename):
+        try:
+            st = os.stat(filename)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def changed(self):
+        """Return the list of files (or glob patterns) whose content changed since the snapshot"""
+        changed = []
+        for filename, stat in self.files.items():
+            new_stat = self._stat(filename)
+            if new_stat == stat:
+                continue
+            self.files[filename] = new_stat
+            digest = file_hash(filename)
+            if digest != self.hashes[filename]:  # ignore mere touches
+                self.hashes[filename] = digest
+                changed.append(filename)
+        changed.extend(name for name, value in self.globs.items() if consulted_value('glob', name) != value)
+        return changed
+
+    def includers(self, filename):
+        """Return the files including filename"""
+        return [f for f, included in self.include_graph.items() if filename in included]
+
+    def wait(self, interval=0.5, timeout=None):
+        """Wait for changes, returning the list of changed files (empty on timeout)"""
+        start = time.monotonic()
+        while timeout is None or time.monotonic() - start < timeout:
+            changed = self.changed()
+            if changed:
+                return changed
+            time.sleep(interval)
+        return []
+
+
+def watch(input_file_name, opts, interval=0.5):
+    """Process input_file_name and regenerate its output on each relevant change until interrupted"""
+    from . import _process, current_context, open_output
+
+    ctx = None
+    changed = []
+    while True:
+        doc = None
+        if ctx is not None:
+            try:  # try to re-expand affected macro calls only
+                doc = update(ctx, changed)
+            except Exception:
+                doc = None
+        if doc is not None:
+            out = open_output(opts['output'])
+            xmlutils.backend.write_pretty_xml(doc, out)
+            if opts['output']:
+                out.close()
+            message("xacro: updated output incrementally")
+        else:
+            try:
+                _process(input_file_name, dict(opts, provenance=not opts.get('just_deps')))
+            except SystemExit:
+                pass  # error was already reported
+            except Exception:
+                traceback.print_exc()
+            ctx = current_context()
+            if ctx.provenance is None or ctx.provenance.doc is None:
+                ctx = None  # processing failed
+        context = ctx or current_context()
+        deps = Dependencies([input_file_name] + context.all_includes, context.include_graph,
+                            context.substitution_args['consulted'])
+        message("xacro: watching %d files for changes" % len(deps.files))
+
+        try:
+            changed = deps.wait(interval)
+        except KeyboardInterrupt:
+            return
+        for filename in changed:
+            includers = [f for f in deps.includers(filename) if f]
+            suffix = " (included from %s)" % ', '.join(includers) if includers else ""
+            message("xacro: %s changed%s" % (filename, suffix), color='yellow')
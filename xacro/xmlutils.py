@@ -30,6 +30,7 @@
 # Authors: Stuart Glaser, William Woodall, Robert Haschke
 # Maintainer: Morgan Quigley <morgan@osrfoundation.org>
 
+import sys
 import xml.dom.minidom
 
 
@@ -47,26 +48,99 @@ def next_sibling_element(node):
     return c
 
 
+def clone_node(node, deep=True):
+    """
+    Faster equivalent of node.cloneNode(deep) for elements, text and comments
+    (minidom's generic implementation validates every single attribute and child)
+    User data handlers are not called.
+    """
+    if not _MINIDOM_INTERNALS:
+        return node.cloneNode(deep)
+    return _clone_node(node, deep)
+
+
+def _clone_node(node, deep):
+    node_type = node.nodeType
+    if node_type == xml.dom.Node.ELEMENT_NODE:
+        clone = xml.dom.minidom.Element(node.tagName, node.namespaceURI, node.prefix)
+        clone.ownerDocument = node.ownerDocument
+        if node._attrs:
+            attrs = clone._attrs = {}
+            attrs_ns = clone._attrsNS = {}
+            for name, attr in node._attrs.items():
+                a = xml.dom.minidom.Attr(name, attr.namespaceURI, attr.localName, attr.prefix)
+                a._value = a.childNodes[0].data = attr._value
+                a.ownerDocument = attr.ownerDocument
+                a.ownerElement = clone
+                a.specified = attr.specified
+                attrs[name] = attrs_ns[(a.namespaceURI, a.localName)] = a
+        if deep:
+            children = clone.childNodes
+            previous = None
+            for child in node.childNodes:
+                c = _clone_node(child, True)
+                c.parentNode = clone
+                c.previousSibling = previous
+                if previous is not None:
+                    previous.nextSibling = c
+                children.append(c)
+                previous = c
+        return clone
+    elif node_type == xml.dom.Node.TEXT_NODE:
+        clone = xml.dom.minidom.Text()
+        clone._data = node._data
+    elif node_type == xml.dom.Node.COMMENT_NODE:
+        clone = xml.dom.minidom.Comment(node._data)
+    else:
+        return node.cloneNode(deep)
+    clone.ownerDocument = node.ownerDocument
+    return clone
+
+
 def replace_node(node, by, content_only=False):
     parent = node.parentNode
 
+    # collect new content
+    nodes = []
     if by is not None:
         if not isinstance(by, list):
             by = [by]
 
-        # insert new content before node
         for doc in by:
             if content_only:
-                c = doc.firstChild
-                while c:
-                    n = c.nextSibling
-                    parent.insertBefore(c, node)
-                    c = n
+                nodes.extend(doc.childNodes)
+                del doc.childNodes[:]
             else:
-                parent.insertBefore(doc, node)
+                if doc.parentNode is not None:
+                    doc.parentNode.removeChild(doc)
+                nodes.append(doc)
+
+    if parent.nodeType == xml.dom.Node.DOCUMENT_NODE:
+        # documents validate their children: use standard DOM methods
+        for c in nodes:
+            c.parentNode = None
+            parent.insertBefore(c, node)
+        parent.removeChild(node)
+        return
 
-    # remove node
-    parent.removeChild(node)
+    # splice new content into parent's children, replacing node
+    # Inserting nodes one-by-one via insertBefore() is quadratic in the number of siblings.
+    index = parent.childNodes.index(node)
+    parent.childNodes[index:index + 1] = nodes
+    previous = node.previousSibling
+    for c in nodes:
+        c.parentNode = parent
+        c.previousSibling = previous
+        if previous is not None:
+            previous.nextSibling = c
+        previous = c
+    next = node.nextSibling
+    if previous is not None:
+        previous.nextSibling = next
+    if next is not None:
+        next.previousSibling = previous
+    node.parentNode = node.previousSibling = node.nextSibling = None
+    xml.dom.minidom._clear_id_cache(parent)
 
 
 def attribute(tag, a):
@@ -143,3 +217,139 @@ def fixed_writexml(self, writer, indent="", addindent="", newl=""):
 
 # replace minidom's function with ours
 xml.dom.minidom.Element.writexml = fixed_writexml
+
+
+class _ListWriter(object):
+    """Writer collecting written strings in a list"""
+
+    def __init__(self, parts):
+        self.write = parts.append
+
+
+def _escape(data):
+    """Equivalent of xml.dom.minidom._write_data, avoiding the replacements if there is nothing to escape"""
+    if '&' in data or '<' in data or '"' in data or '>' in data:
+        return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+    return data
+
+
+def write_pretty_xml(doc, writer, indent='  ', newl='\n', chunk_parts=4096):
+    """
+    Write doc to writer, producing exactly the output of doc.writexml(writer, '', indent, newl).
+    Output is collected and written in large chunks (of about chunk_parts strings),
+    instead of issuing several write() calls per node.
+    """
+    parts = []
+    indents = ['']  # indentation strings by depth
+    fallback = _ListWriter(parts)
+    if not _MINIDOM_INTERNALS:  # use minidom's (slower) serialization
+        doc.writexml(fallback, '', indent, newl)
+        writer.write(''.join(parts))
+        return
+
+    ELEMENT_NODE, TEXT_NODE, COMMENT_NODE = xml.dom.Node.ELEMENT_NODE, xml.dom.Node.TEXT_NODE, xml.dom.Node.COMMENT_NODE
+
+    def write_node(node, depth):
+        if depth == len(indents):
+            indents.append(indents[-1] + indent)
+        node_type = node.nodeType
+        if node_type == ELEMENT_NODE:
+            write_element(node, depth)
+        elif node_type == TEXT_NODE:
+            parts.append(_escape(indents[depth] + node._data + newl))
+        elif node_type == COMMENT_NODE:
+            if "--" in node._data:
+                raise ValueError("'--' is not allowed in a comment node")
+            parts.append(indents[depth] + "<!--" + node._data + "-->" + newl)
+        else:
+            node.writexml(fallback, indents[depth], indent, newl)
+
+    def write_element(node, depth):
+        prefix = indents[depth]
+        tag = node.tagName
+        attrs = node._attrs
+        if attrs:
+            start = prefix + "<" + tag + ''.join([' ' + name + '="' + _escape(attrs[name]._value) + '"'
+                                                 for name in sorted(attrs)])
+        else:
+            start = prefix + "<" + tag
+        children = node.childNodes
+        if not children:
+            parts.append(start + "/>" + newl)
+        elif len(children) == 1 and children[0].nodeType == TEXT_NODE:
+            parts.append(start + ">" + _escape(children[0]._data) + "</" + tag + ">" + newl)
+        else:
+            parts.append(start + ">" + newl)
+            for child in children:
+                # skip whitespace-only text nodes
+                if child.nodeType == TEXT_NODE and (not child._data or child._data.isspace()):
+                    continue
+                write_node(child, depth + 1)
+            parts.append(prefix + "</" + tag + ">" + newl)
+        if len(parts) >= chunk_parts:
+            writer.write(''.join(parts))
+            del parts[:]
+
+    if doc.nodeType == xml.dom.Node.DOCUMENT_NODE:
+        parts.append('<?xml version="1.0" ?>' + newl)
+        for node in doc.childNodes:
+            write_node(node, 0)
+    else:
+        write_node(doc, 0)
+    writer.write(''.join(parts))
+
+
+def pretty_xml(doc, indent='  ', newl='\n'):
+    """Return doc serialized by write_pretty_xml(), i.e. identical to doc.toprettyxml(indent, newl)"""
+    parts = []
+    write_pretty_xml(doc, _ListWriter(parts), indent, newl, chunk_parts=float('inf'))
+    return ''.join(parts)
+
+
+def _check_minidom_internals():
+    """Check that minidom's private node attributes used by clone_node() and write_pretty_xml() work as expected"""
+    try:
+        doc = xml.dom.minidom.parseString('<a x="&lt;" xmlns:b="urn:b" b:y="2">t&amp;<!--c--><b:c/><d> </d></a>')
+        elt = doc.documentElement
+        return _clone_node(elt, True).toxml() == elt.cloneNode(True).toxml() and \
+            pretty_xml(doc) == doc.toprettyxml(indent='  ')
+    except Exception:
+        return False
+
+
+# clone_node() and write_pretty_xml() access minidom's private node attributes (_attrs, _attrsNS, _value, _data)
+# to bypass its slow generic implementations. This is limited to the python versions known to work with it,
+# and verified on import. Otherwise, minidom's public (but slower) API is used.
+_MINIDOM_INTERNALS = True  # tentatively, for checking
+_MINIDOM_INTERNALS = (3, 5) <= sys.version_info[:2] <= (3, 14) and _check_minidom_internals()
+
+
+class MinidomBackend(object):
+    """
+    Tree operations of xacro's processing pipeline (parsing, cloning, splicing, and serialization)
+    for xml.dom.minidom documents. Other backends provide the same methods and are activated via set_backend().
+    """
+    name = 'minidom'
+
+    @staticmethod
+    def parse(inp):
+        """Parse inp, a string or file object, into a document"""
+        if isinstance(inp, str):
+            return xml.dom.minidom.parseString(inp)
+        return xml.dom.minidom.parse(inp)
+
+    clone_node = staticmethod(clone_node)
+    replace_node = staticmethod(replace_node)
+    write_pretty_xml = staticmethod(write_pretty_xml)
+    pretty_xml = staticmethod(pretty_xml)
+
+
+# backend used for all tree operations
+backend = MinidomBackend()
+
+
+def set_backend(new_backend):
+    """Use new_backend for all tree operations, returning the previously used one"""
+    global backend
+    old, backend = backend, new_backend
+    return old